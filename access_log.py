@@ -0,0 +1,114 @@
+import json
+import logging
+import queue
+import sys
+import threading
+import time
+from time import strftime, gmtime
+
+
+STOP = object()
+
+
+class AccessLog(object):
+    """Access log written by a background thread.
+
+    The event loop only puts a tuple of fields on a bounded queue; the
+    writer thread formats the entries and writes them in batches of up to
+    ``batch_size`` lines, or whatever has gathered after
+    ``flush_interval`` seconds.  When the queue is full entries are
+    dropped and counted rather than letting the loop wait for the disk.
+
+    ``path`` of ``-`` logs to stdout.  ``log_format`` is ``text`` (the common
+    log format plus the duration in seconds) or ``json``, one object per
+    line.
+
+    Several servers, e.g. one per thread, can share a log: the writer
+    starts with the first ``start`` and stops with the last ``close``.
+    """
+
+    def __init__(self, path='-', log_format='text', batch_size=256, flush_interval=1.0, max_queue=65536):
+        self.path = path
+        self.log_format = log_format
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue(max_queue)
+        self.dropped = 0
+        self.stream = None
+        self.thread = None
+        self.users = 0
+        self.lock = threading.Lock()
+
+    def start(self):
+        with self.lock:
+            self.users += 1
+            if self.thread is None:
+                self.open()
+
+    def open(self):
+        self.stream = sys.stdout if self.path == '-' else open(self.path, 'a')
+        self.thread = threading.Thread(target=self.run, name='access-log', daemon=True)
+        self.thread.start()
+
+    def close(self):
+        """Write out what is queued and stop the writer, once the last user is done."""
+        with self.lock:
+            if self.thread is None:
+                return
+            self.users -= 1
+            if self.users <= 0:
+                self.stop()
+
+    def stop(self):
+        self.queue.put(STOP)
+        self.thread.join()
+        self.thread = None
+        if self.stream is not sys.stdout:
+            self.stream.close()
+        if self.dropped:
+            logging.warning(f"Access log dropped {self.dropped} entries")
+
+    def log(self, client, method, path, version, status, size, duration):
+        try:
+            self.queue.put_nowait((time.time(), client, method, path, version, status, size, duration))
+        except queue.Full:
+            self.dropped += 1
+
+    def format_entry(self, entry):
+        timestamp, client, method, path, version, status, size, duration = entry
+        if self.log_format == 'json':
+            return json.dumps({
+                'time': timestamp, 'client': client, 'method': method, 'path': path,
+                'version': version, 'status': status, 'bytes': size, 'duration': round(duration, 6),
+            })
+        when = strftime("%d/%b/%Y:%H:%M:%S +0000", gmtime(timestamp))
+        return f'{client or "-"} - - [{when}] "{method} {path} {version}" {status} {size} {duration:.6f}'
+
+    def run(self):
+        batch = []
+        deadline = None
+        while True:
+            timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+            try:
+                entry = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                entry = None
+            if entry is not None and entry is not STOP:
+                batch.append(self.format_entry(entry))
+                if deadline is None:
+                    deadline = time.monotonic() + self.flush_interval
+                if len(batch) < self.batch_size:
+                    continue
+            if batch:
+                self.write(batch)
+                batch = []
+                deadline = None
+            if entry is STOP:
+                return
+
+    def write(self, lines):
+        try:
+            self.stream.write("\n".join(lines) + "\n")
+            self.stream.flush()
+        except (OSError, ValueError) as e:
+            logging.error(f"Can't write the access log: {e}")
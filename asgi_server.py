@@ -0,0 +1,351 @@
+import asyncio
+import collections
+import http
+import logging
+from urllib.parse import unquote
+
+import http_server
+
+
+ASGI_VERSION = {'version': '3.0', 'spec_version': '2.3'}
+
+
+class BodyStream(object):
+    """Request body handed to the application as it arrives.
+
+    Takes the place of ``RequestBody``: chunks are queued for ``receive()``
+    instead of being spooled.
+    """
+
+    def __init__(self):
+        self.size = 0
+        self.chunks = collections.deque()
+        self.buffered = 0
+        self.complete = False
+
+    def write(self, data):
+        self.size += len(data)
+        self.chunks.append(data)
+        self.buffered += len(data)
+
+    def read(self):
+        data = b"".join(self.chunks)
+        self.chunks.clear()
+        self.buffered = 0
+        return data
+
+    def finish(self):
+        self.complete = True
+
+    def close(self):
+        self.chunks.clear()
+
+
+class Lifespan(object):
+    """Runs the ASGI lifespan protocol around the server's lifetime.
+
+    Applications that raise before completing startup are taken not to
+    support lifespan and are served without it.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.state = {}
+        self.messages = asyncio.Queue()
+        self.started = None
+        self.stopped = None
+        self.task = None
+        self.supported = True
+
+    async def startup(self):
+        loop = asyncio.get_running_loop()
+        self.started = loop.create_future()
+        self.stopped = loop.create_future()
+        self.task = loop.create_task(self.run())
+        await self.messages.put({'type': 'lifespan.startup'})
+        await self.started
+
+    async def shutdown(self):
+        if not self.supported or self.task.done():
+            return
+        await self.messages.put({'type': 'lifespan.shutdown'})
+        await self.stopped
+
+    async def run(self):
+        scope = {'type': 'lifespan', 'asgi': ASGI_VERSION, 'state': self.state}
+        try:
+            await self.app(scope, self.receive, self.send)
+        except Exception as e:
+            if not self.started.done():
+                logging.debug(f"Lifespan not supported: {e!r}")
+                self.supported = False
+            else:
+                logging.exception("Error in ASGI lifespan")
+        finally:
+            for future in (self.started, self.stopped):
+                if not future.done():
+                    future.set_result(None)
+
+    async def receive(self):
+        return await self.messages.get()
+
+    async def send(self, message):
+        kind = message['type']
+        if kind == 'lifespan.startup.complete':
+            self.started.set_result(None)
+        elif kind == 'lifespan.startup.failed':
+            self.started.set_exception(RuntimeError(message.get('message') or "Application startup failed"))
+        elif kind == 'lifespan.shutdown.complete':
+            self.stopped.set_result(None)
+        elif kind == 'lifespan.shutdown.failed':
+            logging.error(f"Application shutdown failed: {message.get('message', '')}")
+            self.stopped.set_result(None)
+
+
+class RequestCycle(object):
+    """One request/response exchange with the application.
+
+    ``receive`` and ``send`` belong to the cycle rather than the
+    connection, so an application task that outlives its response can't
+    read or write the next request on the same connection.
+    """
+
+    def __init__(self, handler, body):
+        self.handler = handler
+        self.body = body
+        self.waiter = None
+        self.body_sent = False
+        self.disconnected = False
+        self.status = None
+        self.headers = None
+        self.started = False
+        self.complete = False
+        self.chunked = False
+        self.bodyless = handler.method == 'HEAD'
+
+    def wake(self):
+        if self.waiter is not None and not self.waiter.done():
+            self.waiter.set_result(None)
+
+    async def run(self, app, scope):
+        try:
+            await app(scope, self.receive, self.send)
+        except Exception:
+            logging.exception("Error in ASGI application")
+        if self.complete or self.disconnected:
+            return
+        if not self.started:
+            self.complete = True
+            self.handler.send_error(500)
+        else:
+            # The response can't be finished, so the client must not
+            # mistake what it got for all of it.
+            self.handler.close()
+
+    async def receive(self):
+        while True:
+            if self.disconnected or self.complete:
+                return {'type': 'http.disconnect'}
+            if self.body.chunks or (self.body.complete and not self.body_sent):
+                data = self.body.read()
+                self.body_sent = self.body.complete
+                self.handler.body_consumed()
+                return {'type': 'http.request', 'body': data, 'more_body': not self.body.complete}
+            self.waiter = asyncio.get_running_loop().create_future()
+            await self.waiter
+            self.waiter = None
+
+    async def send(self, message):
+        if self.disconnected:
+            return
+        kind = message['type']
+        if kind == 'http.response.start':
+            if self.started:
+                raise RuntimeError("Response already started")
+            self.started = True
+            self.status = message['status']
+            self.headers = message.get('headers', [])
+        elif kind == 'http.response.body':
+            if not self.started:
+                raise RuntimeError("Response body sent before http.response.start")
+            if self.complete:
+                raise RuntimeError("Response already complete")
+            body = message.get('body', b'')
+            more_body = message.get('more_body', False)
+            output = []
+            if self.headers is not None:
+                output.append(self.response_head(None if more_body else len(body)))
+                self.headers = None
+            if body and not self.bodyless:
+                output.append(http_server.frame(body, self.chunked))
+            if not more_body:
+                if self.chunked:
+                    output.append(b"0\r\n\r\n")
+                self.complete = True
+            self.handler.send(b"".join(output))
+            if self.complete:
+                self.handler.response_done(self)
+            else:
+                try:
+                    await self.handler.drain()
+                except ConnectionError:
+                    pass
+        else:
+            raise RuntimeError(f"Unexpected ASGI message {kind!r}")
+
+    def response_head(self, length):
+        """Status line and headers; ``length`` is the body size if known."""
+        handler = self.handler
+        try:
+            reason = http.HTTPStatus(self.status).phrase
+        except ValueError:
+            reason = ''
+        handler.status_code = self.status
+        lines = [http_server.status_line(self.status, reason)]
+        names = set()
+        for name, value in self.headers:
+            key = name.lower()
+            if key in (b'connection', b'keep-alive', b'transfer-encoding'):
+                continue
+            names.add(key)
+            lines.append(name + b": " + value + b"\r\n")
+        if b'date' not in names:
+            lines.append(handler.server.clock.header)
+        if b'server' not in names:
+            lines.append(http_server.SERVER_HEADER)
+        if self.status in (204, 304) or self.status < 200:
+            self.bodyless = True
+        if b'content-length' not in names and not self.bodyless:
+            if length is not None:
+                lines.append(http_server.header_line("Content-Length", length))
+            elif handler.request_version == 'HTTP/1.1':
+                lines.append(b"Transfer-Encoding: chunked\r\n")
+                self.chunked = True
+            else:
+                handler.close_connection = True
+        if not self.body.complete:
+            # Unread body bytes would be taken for the next request.
+            handler.close_connection = True
+        lines.append(http_server.CONNECTION_HEADERS[handler.close_connection])
+        lines.append(b"\r\n")
+        return b"".join(lines)
+
+
+class AsyncASGIServer(http_server.AsyncServer):
+    """Server for an ASGI 3 application, with lifespan events."""
+
+    def set_app(self, app):
+        self.application = app
+        self.lifespan = None
+
+    def get_app(self):
+        return self.application
+
+    async def startup(self):
+        self.lifespan = Lifespan(self.application)
+        await self.lifespan.startup()
+
+    async def cleanup(self):
+        if self.lifespan is not None:
+            await self.lifespan.shutdown()
+
+
+class AsyncASGIRequestHandler(http_server.AsyncHTTPRequestHandler):
+    """Runs the ASGI application for each request.
+
+    The application starts as soon as the headers are in and receives the
+    body as it arrives.  Reading pauses while more than
+    ``write_buffer_limit`` bytes of body wait for ``receive()``, and
+    ``send()`` waits for the client whenever the transport buffer is full.
+    """
+
+    __slots__ = ('cycle',)
+
+    def __init__(self, server):
+        self.cycle = None
+        super().__init__(server)
+
+    def create_request_body(self):
+        return BodyStream()
+
+    def empty_request_body(self):
+        # The application reads even an empty body through receive().
+        return BodyStream()
+
+    def collect_incoming_data(self, data):
+        super().collect_incoming_data(data)
+        if self.request_body.buffered > self.server.write_buffer_limit:
+            self.transport.pause_reading()
+        if self.cycle is not None:
+            self.cycle.wake()
+
+    def body_consumed(self):
+        if self.transport is not None and self.drain_waiter is None:
+            self.transport.resume_reading()
+
+    def found_headers(self):
+        super().found_headers()
+        if self.request_body is not None and self.cycle is None:
+            self.route = 'asgi'
+            self.cycle = RequestCycle(self, self.request_body)
+            self.server.loop.create_task(self.cycle.run(self.server.get_app(), self.get_scope()))
+
+    def found_body(self):
+        self.cancel_read_timeout()
+        self.request_body.finish()
+        # Pipelined requests wait until this response is done.
+        self.busy = True
+        if self.cycle is not None:
+            self.cycle.wake()
+
+    def handle_read_timeout(self):
+        if self.read_phase == 'body' and self.request_body.buffered > self.server.write_buffer_limit:
+            # Reading is paused because the application hasn't taken the
+            # body yet; the client isn't the one stalling.
+            self.set_read_timeout('body')
+            return
+        super().handle_read_timeout()
+
+    def get_scope(self):
+        path, _, query = self.path.partition('?')
+        peer = self.transport.get_extra_info('peername')
+        return {
+            'type': 'http',
+            'asgi': ASGI_VERSION,
+            'http_version': self.request_version[5:],
+            'method': self.method,
+            'scheme': 'http',
+            'path': unquote(path),
+            'raw_path': path.encode('latin-1'),
+            'query_string': query.encode('latin-1'),
+            'root_path': '',
+            'headers': [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                        for name, value in self.headers.raw],
+            'client': peer[:2] if peer else None,
+            'server': (self.server_name, self.server_port),
+            'state': dict(self.server.lifespan.state),
+        }
+
+    def response_done(self, cycle):
+        if cycle is self.cycle:
+            self.end_request()
+
+    def reset(self):
+        super().reset()
+        self.cycle = None
+
+    def send_error(self, code, message=None):
+        if self.cycle is not None:
+            if self.cycle.started:
+                self.close()
+                return
+            self.cycle.complete = True
+            if not self.request_body.complete:
+                self.close_connection = True
+        super().send_error(code, message)
+
+    def connection_lost(self, exc):
+        if self.cycle is not None:
+            self.cycle.disconnected = True
+            self.cycle.wake()
+        super().connection_lost(exc)
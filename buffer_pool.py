@@ -0,0 +1,24 @@
+class BufferPool(object):
+    """Free list of fixed-size ``bytearray`` receive buffers.
+
+    A transport reads into a buffer from ``acquire`` and the protocol
+    hands it back with ``release`` as soon as the bytes are consumed, so
+    reads don't allocate and a handful of buffers serve every connection
+    of the loop.  At most ``max_free`` idle buffers are kept.
+    """
+
+    def __init__(self, size=65536, max_free=8):
+        self.size = size
+        self.max_free = max_free
+        self.free = []
+        self.allocated = 0
+
+    def acquire(self):
+        if self.free:
+            return self.free.pop()
+        self.allocated += 1
+        return bytearray(self.size)
+
+    def release(self, buffer):
+        if len(self.free) < self.max_free:
+            self.free.append(buffer)
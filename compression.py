@@ -0,0 +1,153 @@
+import collections
+import gzip
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+# Preferred first.
+ENCODINGS = ('br', 'gzip')
+
+SIDECAR_SUFFIXES = {
+    'br': '.br',
+    'gzip': '.gz',
+}
+
+COMPRESSIBLE_TYPES = {
+    'application/javascript',
+    'application/x-javascript',
+    'application/json',
+    'application/xml',
+    'application/xhtml+xml',
+    'image/svg+xml',
+}
+
+
+def compressible(file_type):
+    return file_type is not None and (file_type.startswith('text/') or file_type in COMPRESSIBLE_TYPES)
+
+
+def parse_accept_encoding(header):
+    """Map each content-coding named in an Accept-Encoding header to its q-value."""
+    codings = {}
+    for item in header.split(','):
+        coding, _, params = item.partition(';')
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        quality = 1.0
+        for param in params.split(';'):
+            name, _, value = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        codings[coding] = quality
+    return codings
+
+
+def accepts(codings, coding):
+    if coding in codings:
+        return codings[coding] > 0
+    return codings.get('*', 0) > 0
+
+
+def available(encoding):
+    """Whether ``encoding`` can be produced on the fly."""
+    return encoding == 'gzip' or (encoding == 'br' and brotli is not None)
+
+
+def compress(data, encoding):
+    if encoding == 'gzip':
+        return gzip.compress(data, compresslevel=6, mtime=0)
+    if encoding == 'br' and brotli is not None:
+        # The default quality of 11 takes seconds per megabyte.
+        return brotli.compress(data, quality=5)
+    raise ValueError(f"Unsupported encoding {encoding}")
+
+
+def compress_file(body, path, size, encoding):
+    """Compress ``body``, or the ``size`` bytes of the file at ``path`` if it is None.
+
+    Meant to run in a pool thread.  Returns None when compression doesn't
+    make the body smaller, or the file no longer has that size.
+    """
+    if body is None:
+        with open(path, 'rb') as f:
+            body = f.read(size + 1)
+        if len(body) != size:
+            return None
+    compressed = compress(body, encoding)
+    return compressed if len(compressed) < len(body) else None
+
+
+class CompressedCache(object):
+    """LRU cache of encoded file variants, capped by total body size.
+
+    Sidecar variants and None markers hold no body, so the number of keys
+    is capped too, at ``max_entries``; otherwise the keys of every ETag
+    ever served would pile up.
+
+    Keys are ``(ETag, encoding)``, so a changed file simply stops being
+    looked up and its variants age out.  A key may map to None, meaning
+    compression didn't make the file smaller and it isn't worth retrying.
+    ``pending`` holds the keys being compressed in the background.  Files
+    smaller than ``min_size`` or larger than ``max_size`` are never
+    compressed on the fly.
+    """
+
+    def __init__(self, max_bytes=8 * 1024 * 1024, min_size=1024, max_size=1024 * 1024, max_entries=4096):
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.min_size = min_size
+        self.max_size = max_size
+        self.entries = collections.OrderedDict()
+        self.pending = set()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def worth_compressing(self, file_type, size):
+        return self.min_size <= size <= self.max_size and compressible(file_type)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key):
+        if key not in self.entries:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return self.entries[key]
+
+    def put(self, key, variant):
+        cost = len(variant.body) if variant is not None and variant.body is not None else 0
+        if cost > self.max_bytes:
+            return
+        self.remove(key)
+        self.entries[key] = variant
+        self.size += cost
+        while self.size > self.max_bytes or len(self.entries) > self.max_entries:
+            _, evicted = self.entries.popitem(last=False)
+            if evicted is not None and evicted.body is not None:
+                self.size -= len(evicted.body)
+            self.evictions += 1
+
+    def remove(self, key):
+        variant = self.entries.pop(key, None)
+        if variant is not None and variant.body is not None:
+            self.size -= len(variant.body)
+
+    def stats(self):
+        return {
+            'entries': len(self.entries),
+            'bytes': self.size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
@@ -0,0 +1,128 @@
+import collections
+import copy
+import os
+import time
+from email.utils import formatdate
+
+
+def make_etag(stat):
+    return f'"{stat.st_ino:x}-{stat.st_size:x}-{stat.st_mtime_ns:x}"'
+
+
+class CachedFile(object):
+    """File metadata, validators and the headers that never change for it.
+
+    ``body`` holds the file contents for entries kept in ``FileCache``; it
+    is None for files that are streamed from disk instead.
+    ``header_block``, the encoded status line and fixed headers, is filled
+    in by the request handler.
+
+    ``sidecars`` maps content-codings to the ``(path, stat result)`` of
+    precompressed files found next to this one, and ``vary`` records
+    whether responses depend on Accept-Encoding.
+    """
+
+    def __init__(self, path, body, file_type, stat):
+        self.path = path
+        self.body = body
+        self.file_type = file_type
+        self.size = stat.st_size
+        self.mtime = stat.st_mtime_ns
+        self.etag = make_etag(stat)
+        self.last_modified = formatdate(stat.st_mtime, usegmt=True)
+        self.modified_seconds = int(stat.st_mtime)
+        self.header_block = b''
+        self.encoding = None
+        self.sidecars = {}
+        self.vary = False
+        self.checked = time.monotonic()
+
+    def changed(self, stat):
+        return stat.st_size != self.size or stat.st_mtime_ns != self.mtime
+
+    def variant(self, encoding, body=None, path=None, size=None):
+        """Copy of this entry describing its ``encoding``-encoded form.
+
+        The variant gets its own ETag.  Its body is either ``body`` or the
+        file at ``path`` (a precompressed sidecar) of ``size`` bytes.
+        """
+        variant = copy.copy(self)
+        variant.encoding = encoding
+        variant.body = body
+        variant.path = path
+        variant.size = len(body) if body is not None else size
+        variant.etag = f'{self.etag[:-1]}-{encoding}"'
+        variant.header_block = b''
+        return variant
+
+
+class FileCache(object):
+    """LRU cache of small static files, capped by total body size.
+
+    Entries are keyed by the normalized request path.  An entry is
+    re-validated against ``os.stat`` at most once per ``check_interval``
+    seconds; if the file changed or disappeared it is dropped and the
+    lookup counts as a miss.
+    """
+
+    def __init__(self, max_bytes=16 * 1024 * 1024, max_file_size=1024 * 1024, check_interval=1.0):
+        self.max_bytes = max_bytes
+        self.max_file_size = max_file_size
+        self.check_interval = check_interval
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        now = time.monotonic()
+        if now - entry.checked >= self.check_interval:
+            try:
+                stat = os.stat(entry.path)
+            except OSError:
+                stat = None
+            if stat is None or entry.changed(stat):
+                self.remove(key)
+                self.misses += 1
+                return None
+            entry.checked = now
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry
+
+    def cacheable(self, size):
+        return size <= self.max_file_size and size <= self.max_bytes
+
+    def put(self, key, entry):
+        if not self.cacheable(len(entry.body)):
+            return
+        self.remove(key)
+        self.entries[key] = entry
+        self.size += len(entry.body)
+        while self.size > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= len(evicted.body)
+            self.evictions += 1
+
+    def remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= len(entry.body)
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
+
+    def stats(self):
+        return {
+            'entries': len(self.entries),
+            'bytes': self.size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
@@ -0,0 +1,129 @@
+import re
+
+
+TOKEN = re.compile(rb"[!#$%&'*+\-.^_`|~0-9A-Za-z]+")
+VERSION = re.compile(rb"HTTP/1\.[0-9]")
+DIGITS = re.compile(r"[0-9]+")
+
+
+class HTTPParseError(Exception):
+    """Malformed or oversized request; ``code`` is the status to answer with."""
+
+    def __init__(self, code, message=None):
+        super().__init__(message or str(code))
+        self.code = code
+
+
+class Headers(dict):
+    """Request headers keyed by lower-cased name.
+
+    Lookups are case-insensitive.  Repeated fields are combined into one
+    comma-separated value, as RFC 7230 allows; ``raw`` keeps every field
+    with its original name in arrival order.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.raw = []
+
+    def add(self, name, value):
+        key = name.lower()
+        if dict.__contains__(self, key):
+            dict.__setitem__(self, key, dict.__getitem__(self, key) + ', ' + value)
+        else:
+            dict.__setitem__(self, key, value)
+        self.raw.append((name, value))
+
+    def __getitem__(self, key):
+        return dict.__getitem__(self, key.lower())
+
+    def __setitem__(self, key, value):
+        dict.__setitem__(self, key.lower(), value)
+
+    def __contains__(self, key):
+        return dict.__contains__(self, key.lower())
+
+    def get(self, key, default=None):
+        return dict.get(self, key.lower(), default)
+
+
+class RequestParser(object):
+    """Incremental parser for the request line and header block.
+
+    ``parse`` is called with the connection's input ``bytearray`` each time
+    more data arrives.  It only searches the bytes it hasn't looked at yet
+    for the end of the head, then splits the head in a single pass.
+    """
+
+    def __init__(self, max_header_size=65536, max_headers=100, max_line=8190):
+        self.max_header_size = max_header_size
+        self.max_headers = max_headers
+        self.max_line = max_line
+        self.scanned = 0
+
+    def reset(self):
+        self.scanned = 0
+
+    def parse(self, buffer):
+        """Parse a request head at the start of ``buffer``.
+
+        Returns ``(method, target, version, headers, consumed)`` or None if
+        the head isn't complete yet.  Raises ``HTTPParseError`` with 400,
+        414 or 431 for bad requests.
+        """
+        start = 0
+        # Empty lines before the request line are allowed and skipped.
+        while buffer.startswith(b"\r\n", start):
+            start += 2
+        end = buffer.find(b"\r\n\r\n", max(start, self.scanned - 3))
+        if end == -1:
+            self.scanned = len(buffer)
+            line_end = buffer.find(b"\r\n", start)
+            if line_end == -1 and len(buffer) - start > self.max_line:
+                raise HTTPParseError(414)
+            if len(buffer) - start > self.max_header_size:
+                raise HTTPParseError(431)
+            return None
+        if end - start > self.max_header_size:
+            raise HTTPParseError(431)
+        self.scanned = 0
+        lines = bytes(memoryview(buffer)[start:end]).split(b"\r\n")
+
+        request_line = lines[0]
+        if len(request_line) > self.max_line:
+            raise HTTPParseError(414)
+        parts = request_line.split(b" ")
+        if len(parts) != 3:
+            raise HTTPParseError(400, "Malformed request line")
+        method, target, version = parts
+        if not TOKEN.fullmatch(method) or not target or not VERSION.fullmatch(version):
+            raise HTTPParseError(400, "Malformed request line")
+
+        if len(lines) - 1 > self.max_headers:
+            raise HTTPParseError(431)
+        fields = []
+        for line in lines[1:]:
+            if line[:1] in (b" ", b"\t"):
+                # Obsolete line folding: continue the previous value.
+                if not fields:
+                    raise HTTPParseError(400, "Folded header without a field")
+                fields[-1][1] += b" " + line.strip(b" \t")
+                continue
+            name, sep, value = line.partition(b":")
+            if not sep or not TOKEN.fullmatch(name):
+                raise HTTPParseError(400, "Malformed header field")
+            fields.append([name, value.strip(b" \t")])
+
+        headers = Headers()
+        for name, value in fields:
+            headers.add(name.decode('latin-1'), value.decode('latin-1'))
+        content_length = headers.get('content-length')
+        if content_length is not None:
+            values = {value.strip() for value in content_length.split(',')}
+            if len(values) != 1 or not DIGITS.fullmatch(next(iter(values))):
+                raise HTTPParseError(400, "Invalid Content-Length")
+            headers['content-length'] = values.pop()
+        if 'host' in headers and ',' in headers['host']:
+            raise HTTPParseError(400, "Multiple Host headers")
+        return (method.decode('ascii'), target.decode('latin-1'), version.decode('ascii'),
+                headers, end + 4)
@@ -0,0 +1,61 @@
+import time
+from time import strftime, gmtime
+
+
+SERVER_HEADER = b"Server: 127.0.0.1\r\n"
+
+CONNECTION_HEADERS = {
+    True: b"Connection: close\r\n",
+    False: b"Connection: keep-alive\r\n",
+}
+
+# Encoded status lines by (code, reason), filled in as they are used.
+STATUS_LINES = {}
+
+
+def status_line(code, message):
+    """``HTTP/1.1 <code> <message>`` with its CRLF, as bytes."""
+    key = (code, message)
+    line = STATUS_LINES.get(key)
+    if line is None:
+        line = f"HTTP/1.1 {code} {message}\r\n".encode('latin-1')
+        # Applications choose their own reasons; don't keep every one.
+        if len(STATUS_LINES) < 1024:
+            STATUS_LINES[key] = line
+    return line
+
+
+def header_line(name, value):
+    return f"{name}: {value}\r\n".encode('latin-1')
+
+
+class DateClock(object):
+    """The ``Date`` header, formatted once a second instead of per response.
+
+    ``text`` is the HTTP-date and ``header`` the complete encoded header
+    line.  Once started, the value is refreshed on the loop just after
+    every second boundary.
+    """
+
+    def __init__(self):
+        self.loop = None
+        self.handle = None
+        self.update(time.time())
+
+    def update(self, now):
+        self.text = strftime("%a, %d %b %Y %H:%M:%S GMT", gmtime(now))
+        self.header = b"Date: " + self.text.encode('latin-1') + b"\r\n"
+
+    def start(self, loop):
+        self.loop = loop
+        self.tick()
+
+    def tick(self):
+        now = time.time()
+        self.update(now)
+        self.handle = self.loop.call_later(1.0 - now % 1.0, self.tick)
+
+    def stop(self):
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
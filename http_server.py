@@ -1,156 +1,997 @@
-import asyncore
-import asynchat
-import multiprocessing
+import asyncio
+import errno
+import functools
+import importlib.util
+import inspect
+import secrets
 import logging
 import os
-import mimetypes
-from urllib.parse import unquote
+import re
+import resource
+import selectors
+import signal
+import socket
+import tempfile
+import time
+import shutil
+import sys
 import argparse
-from time import strftime, gmtime
+from http_parser import RequestParser, HTTPParseError, Headers
+from buffer_pool import BufferPool
+from request_body import RequestBody, ChunkedDecoder, EMPTY_BODY
+from email.utils import parsedate_to_datetime
+from file_cache import FileCache, CachedFile
+import compression
+from compression import CompressedCache
+from prefork import Master
+from server_threads import ServerThreads
+from metrics import Metrics
+from timer_wheel import TimerWheel
+from access_log import AccessLog
+from path_resolver import PathResolver, url_normalize
+from http_response import DateClock, status_line, header_line, SERVER_HEADER, CONNECTION_HEADERS
 
 
-def url_normalize(path):
-    if path.startswith("."):
-        path = "/" + path
-    while "../" in path:
-        p1 = path.find("/..")
-        p2 = path.rfind("/", 0, p1)
-        if p2 != -1:
-            path = path[:p2] + path[p1 + 3:]
-        else:
-            path = path.replace("/..", "", 1)
-    path = path.replace("/./", "/")
-    path = unquote(path)
-    if "?" in path:
-        path = path[:path.find('?')]
-    return path
+RANGE_SPEC = re.compile(r"([0-9]*)-([0-9]*)\Z")
+
 
+def parse_range(header, size, max_ranges=16):
+    """Parse a ``Range`` header against a representation of ``size`` bytes.
 
-def read_file(path):
-    file = bytes()
-    fp = FileProducer(open(path, 'rb'))
-    while True:
-        cur_chunk = fp.more()
-        if not cur_chunk:
-            break
-        file += cur_chunk
-    return file
+    Returns a sorted list of non-overlapping inclusive ``(start, end)``
+    pairs, an empty list if the specs are well formed but none is
+    satisfiable, or None if the header is malformed, has no spec a range
+    can be made of, or asks for too many ranges, and should be ignored.
+    """
+    unit, _, specs = header.partition('=')
+    if unit.strip().lower() != 'bytes':
+        return None
+    ranges = []
+    parsed = 0
+    for spec in specs.split(','):
+        spec = spec.strip()
+        if not spec:
+            continue
+        match = RANGE_SPEC.match(spec)
+        if match is None or match.group() == '-':
+            return None
+        first, last = match.groups()
+        if not first:
+            length = int(last)
+            if not length:
+                # Asks for nothing, so there is no range to satisfy.
+                continue
+            start, end = max(0, size - length), size - 1
+        else:
+            start = int(first)
+            end = int(last) if last else None
+            if end is not None and end < start:
+                return None
+            end = size - 1 if end is None else min(end, size - 1)
+        parsed += 1
+        if start < size:
+            ranges.append((start, end))
+    if not parsed:
+        return None
+    if len(ranges) > max_ranges:
+        return None
+    ranges.sort()
+    merged = []
+    for start, end in ranges:
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
 
 
 class FileProducer(object):
+    """Reads ``count`` bytes (or up to EOF) of an open file in chunks.
+
+    With ``offset`` set the file is positioned there before the first read.
+    """
 
-    def __init__(self, file, chunk_size=4096):
+    def __init__(self, file, chunk_size=65536, offset=None, count=None):
         self.file = file
         self.chunk_size = chunk_size
+        self.offset = offset
+        self.remaining = count
 
     def more(self):
         if self.file:
-            data = self.file.read(self.chunk_size)
+            if self.offset is not None:
+                self.file.seek(self.offset)
+                self.offset = None
+            size = self.chunk_size
+            if self.remaining is not None:
+                size = min(size, self.remaining)
+            data = self.file.read(size) if size else b""
             if data:
+                if self.remaining is not None:
+                    self.remaining -= len(data)
                 return data
+            self.close()
+        return b""
+
+    def close(self):
+        if self.file:
             self.file.close()
             self.file = None
-        return ""
 
 
-class AsyncServer(asyncore.dispatcher):
+def frame(data, chunked):
+    """Frame ``data`` as one HTTP/1.1 chunk when ``chunked`` is set."""
+    if chunked:
+        return b"%x\r\n%s\r\n" % (len(data), data)
+    return data
+
+
+SELECTORS = {
+    'epoll': 'EpollSelector',
+    'kqueue': 'KqueueSelector',
+    'poll': 'PollSelector',
+    'select': 'SelectSelector',
+}
+
+LOOPS = ('auto', 'uvloop') + tuple(SELECTORS)
+
+MODELS = ('async', 'threads', 'prefork-threads')
+
+
+def new_event_loop(name='auto'):
+    """Create an event loop on the named reactor.
+
+    ``auto`` goes through the current event loop policy, which on Linux
+    means epoll.  The selector backends keep each file descriptor
+    registered and only modify its interest when a connection starts or
+    stops reading or writing, so the cost of an iteration depends on the
+    number of ready connections rather than open ones (except ``select``).
+    """
+    if name == 'auto':
+        return asyncio.new_event_loop()
+    if name == 'uvloop':
+        import uvloop
+        return uvloop.new_event_loop()
+    selector_class = getattr(selectors, SELECTORS[name], None)
+    if selector_class is None:
+        raise ValueError(f"The {name} reactor isn't available on this platform")
+    return asyncio.SelectorEventLoop(selector_class())
+
+
+def loop_unavailable(name):
+    """Why the named reactor can't be used here, or None if it can."""
+    if name == 'uvloop':
+        if importlib.util.find_spec('uvloop') is None:
+            return "uvloop isn't installed"
+    elif name in SELECTORS and not hasattr(selectors, SELECTORS[name]):
+        return f"The {name} reactor isn't available on this platform"
+    return None
+
+
+def raise_fd_limit():
+    """Lift the soft open-file limit to the hard limit."""
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    return hard
+
+
+def bind_socket(host, port, reuse_port=False, backlog=1024):
+    sock = socket.create_server((host, port), backlog=backlog, reuse_port=reuse_port)
+    sock.setblocking(False)
+    return sock
+
+
+SENDFILE_SEGMENT = 1024 * 1024
+
+OVERLOADED = (b"HTTP/1.1 503 Service Unavailable\r\n"
+              b"Content-Type: text/plain\r\n"
+              b"Content-Length: 21\r\n"
+              b"Retry-After: 1\r\n"
+              b"Connection: close\r\n\r\n"
+              b"Server is overloaded\n")
+
+
+# Bytes of Python heap an idle keep-alive connection may take, not
+# counting the transport and socket that asyncio keeps for it.
+CONNECTION_MEMORY_BUDGET = 1024
+
+# Stands in for the headers between requests; never modified.
+EMPTY_HEADERS = Headers()
 
-    def __init__(self, host="127.0.0.1", port=9000, handler_class = None):
-        super().__init__()
-        self.create_socket()
-        self.set_reuse_addr()
-        self.bind((host, port))
-        self.listen(5)
+BYTES_TYPES = (bytes, bytearray, memoryview)
+
+# Before 3.12 the selector transports' writelines joins its buffers into
+# one string instead of gathering them into one sendmsg.
+WRITELINES_GATHERS = sys.version_info >= (3, 12)
+
+# Buffers at least this large are written on their own rather than
+# copied into a join when writelines doesn't gather.
+JOIN_LIMIT = 32 * 1024
+
+
+class AsyncServer(object):
+    """Listening socket plus the asyncio loop that serves it.
+
+    ``loop`` names the reactor the event loop runs on, see
+    ``new_event_loop``.
+
+    ``sock`` is an already listening socket, e.g. one inherited from a
+    pre-fork master; otherwise one is bound here.  SIGTERM starts a
+    graceful shutdown, SIGINT stops at once; a server running outside the
+    main thread leaves the signals to whoever started it, see
+    ``ServerThreads``.
+
+    With ``metrics`` every request is recorded there, and the metrics are
+    served as Prometheus text at ``metrics_path`` and/or to any request
+    on the separate listening socket ``metrics_sock``.
+
+    At most ``max_connections`` connections are open at once.  The one
+    that hits the limit is answered with a canned 503 and accepting stops
+    until the count falls back below 90% of the limit; meanwhile new
+    clients wait in the listen backlog instead of slowing down the ones
+    being served.  Slow clients are cut off by the timeouts:
+    ``header_timeout`` for the whole request head, ``body_timeout`` and
+    ``write_timeout`` for the body or the response making no progress,
+    and ``keepalive_timeout`` between requests.
+
+    Static files are looked up under ``document_root``, see
+    ``PathResolver``; ``path_cache_size`` bounds the resolved paths kept.
+
+    Requests are logged to ``access_log`` if given.  With debug logging
+    on, only one in ``debug_sample`` connections and requests is traced.
+    """
+
+    def __init__(self, host="127.0.0.1", port=9000, handler_class=None,
+                 keepalive_requests=100, keepalive_timeout=5.0, header_timeout=10.0, body_timeout=30.0,
+                 write_timeout=30.0, write_buffer_limit=65536,
+                 document_root='.', path_cache_size=4096, file_cache=None, compressed_cache=None,
+                 max_header_size=65536, max_headers=100, max_body_size=10 * 1024 * 1024, spool_threshold=262144,
+                 sock=None, reuse_port=False, backlog=1024, max_connections=10000,
+                 graceful_timeout=30.0, loop='auto', access_log=None, debug_sample=1,
+                 metrics=None, metrics_path=None, metrics_sock=None):
+        self.host = host
+        self.port = port
         self.handler_class = handler_class
+        self.keepalive_requests = keepalive_requests
+        self.keepalive_timeout = keepalive_timeout
+        self.header_timeout = header_timeout
+        self.body_timeout = body_timeout
+        self.write_timeout = write_timeout
+        self.write_buffer_limit = write_buffer_limit
+        self.resolver = PathResolver(document_root, max_entries=path_cache_size)
+        self.file_cache = file_cache
+        self.compressed_cache = compressed_cache
+        self.max_header_size = max_header_size
+        self.max_headers = max_headers
+        self.max_body_size = max_body_size
+        self.spool_threshold = spool_threshold
+        self.graceful_timeout = graceful_timeout
+        self.loop_name = loop
+        self.backlog = backlog
+        self.max_connections = max_connections
+        self.socket = sock if sock is not None else bind_socket(host, port, reuse_port, backlog)
+        self.loop = None
+        self.timers = TimerWheel()
+        self.buffers = BufferPool()
+        self.clock = DateClock()
+        self.accepting = False
+        self.access_log = access_log
+        self.debug_sample = debug_sample
+        self.debug_count = 0
+        self.metrics = metrics
+        self.metrics_path = metrics_path
+        self.metrics_sock = metrics_sock
+        self.metrics_server = None
+        self.connections = set()
+        # Accepted sockets, including those whose protocol isn't set up yet.
+        self.admitted = 0
+        self.stopping = False
+
+    def protocol_factory(self):
+        return self.handler_class(self)
 
-    def handle_accepted(self, sock, addr):
-        logging.debug(f"Incoming connection from {addr}")
-        self.handler_class(sock)
+    def metrics_protocol_factory(self):
+        self.admitted += 1
+        handler = self.handler_class(self)
+        handler.metrics_only = True
+        return handler
 
-    def serve_forever(self):
+    def serve_forever(self, install_signals=True):
+        self.loop = new_event_loop(self.loop_name)
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_until_complete(self.startup())
+        if self.access_log is not None:
+            self.access_log.start()
+        self.timers.start(self.loop)
+        self.clock.start(self.loop)
+        self.resolver.start(self.loop)
+        self.start_accepting()
+        if self.metrics_sock is not None:
+            self.metrics_server = self.loop.run_until_complete(
+                self.loop.create_server(self.metrics_protocol_factory, sock=self.metrics_sock))
+        if self.metrics is not None:
+            self.metrics.start(self)
+        if install_signals:
+            self.loop.add_signal_handler(signal.SIGTERM, self.shutdown)
+            self.loop.add_signal_handler(signal.SIGINT, self.loop.stop)
         try:
-            asyncore.loop()
-        except KeyboardInterrupt:
-            logging.debug("Shutting down")
+            self.loop.run_forever()
         finally:
+            logging.debug("Shutting down")
+            self.loop.run_until_complete(self.cleanup())
+            if self.metrics is not None:
+                self.metrics.unpublish()
+            if self.access_log is not None:
+                self.access_log.close()
+            for cache, stats in self.cache_stats().items():
+                logging.info(f"{cache.capitalize()} cache: {stats}")
             self.close()
 
+    def cache_stats(self):
+        """Counters and sizes of the caches, by cache name."""
+        caches = {'path': self.resolver.stats()}
+        if self.file_cache is not None:
+            caches['file'] = self.file_cache.stats()
+        if self.compressed_cache is not None:
+            caches['compressed'] = self.compressed_cache.stats()
+        return caches
+
+    async def startup(self):
+        """Run on the loop before the first connection is accepted."""
+
+    async def cleanup(self):
+        """Run on the loop after it stops serving."""
+
+    def sample_debug(self):
+        """Whether to trace this connection or request at debug level."""
+        if not logging.root.isEnabledFor(logging.DEBUG):
+            return False
+        self.debug_count += 1
+        return self.debug_count % self.debug_sample == 0
+
+    def start_accepting(self):
+        if not self.accepting and not self.stopping:
+            self.accepting = True
+            self.loop.add_reader(self.socket.fileno(), self.accept_connections)
+
+    def pause_accepting(self):
+        if self.accepting:
+            self.accepting = False
+            self.loop.remove_reader(self.socket.fileno())
+
+    def accept_connections(self):
+        """Accept whatever is queued on the listening socket, up to the limit."""
+        for _ in range(self.backlog):
+            try:
+                conn, address = self.socket.accept()
+            except (BlockingIOError, InterruptedError):
+                # Drained, or another worker got there first.
+                return
+            except OSError as e:
+                if e.errno not in (errno.EMFILE, errno.ENFILE, errno.ENOBUFS, errno.ENOMEM):
+                    raise
+                logging.error(f"Can't accept connections: {e}")
+                self.pause_accepting()
+                self.loop.call_later(1.0, self.start_accepting)
+                return
+            if self.max_connections and self.admitted >= self.max_connections:
+                self.reject(conn)
+                self.pause_accepting()
+                return
+            self.admitted += 1
+            conn.setblocking(False)
+            self.loop.create_task(self.connect(conn))
+
+    async def connect(self, conn):
+        try:
+            await self.loop.connect_accepted_socket(self.protocol_factory, conn)
+        except Exception as e:
+            logging.debug(f"Can't set up connection: {e!r}")
+            conn.close()
+            self.admitted -= 1
+
+    def reject(self, conn):
+        """Answer a connection over the limit with 503 without reading it."""
+        logging.warning(f"{self.admitted} connections open, refusing more")
+        try:
+            conn.setblocking(False)
+            conn.send(OVERLOADED)
+        except OSError:
+            pass
+        conn.close()
 
-class AsyncHTTPRequestHandler(asynchat.async_chat):
+    def shutdown(self):
+        """Stop accepting and stop the loop once open requests are answered.
 
-    def __init__(self, sock):
-        super().__init__(sock)
-        self.set_terminator(b"\r\n\r\n")
-        self.ibuffer = ''
-        self.obuffer = ''
+        Idle keep-alive connections are closed straight away; the others
+        are closed after their current response.  Whatever is still open
+        after ``graceful_timeout`` seconds is dropped.
+        """
+        if self.stopping:
+            return
+        self.stopping = True
+        logging.info(f"Draining {len(self.connections)} connections")
+        self.pause_accepting()
+        if self.metrics_server is not None:
+            self.metrics_server.close()
+        for connection in list(self.connections):
+            connection.shutdown()
+        self.loop.call_later(self.graceful_timeout, self.loop.stop)
+        if not self.connections:
+            self.loop.stop()
+
+    def connection_closed(self, connection):
+        self.connections.discard(connection)
+        self.admitted -= 1
+        if not self.accepting and self.admitted < self.max_connections * 0.9:
+            self.start_accepting()
+        if self.stopping and not self.connections:
+            self.loop.stop()
+
+    def close(self):
+        if self.metrics_server is not None:
+            self.metrics_server.close()
+            self.loop.run_until_complete(self.metrics_server.wait_closed())
+            self.metrics_server = None
+        if self.loop is not None:
+            self.pause_accepting()
+            self.timers.stop()
+            self.clock.stop()
+            self.resolver.stop()
+            self.loop.close()
+            self.loop = None
+        self.socket.close()
+
+
+class AsyncHTTPRequestHandler(asyncio.BufferedProtocol):
+    """HTTP protocol instance, one per connection.
+
+    Incoming bytes accumulate in ``inbuffer``; ``RequestParser`` picks the
+    request line and headers out of it.  The body, framed by
+    ``Content-Length`` or chunked transfer coding, is then streamed into a
+    ``RequestBody`` as it arrives and the request is dispatched to
+    ``do_<METHOD>`` once it is complete.
+
+    Connections are persistent: after a response ``end_request`` either
+    closes the transport or resets the per-request state and carries on
+    with whatever is left in the input buffer, so pipelined requests are
+    answered in the order they arrived.
+
+    Output goes through ``producer_fifo`` much like asynchat's: byte
+    strings and producers are queued and written in order, and a response
+    is only complete once the queue has drained into the transport.  When
+    the transport buffer passes ``write_buffer_limit`` the connection stops
+    reading until the client catches up.
+
+    At ten thousands of connections their footprint matters, so there
+    are slots instead of an instance dict (subclasses declare their own
+    too), an idle connection holds no per-request objects and reads go
+    into receive buffers borrowed from the server's ``BufferPool``.
+    ``CONNECTION_MEMORY_BUDGET`` is what an idle connection may cost.
+    """
+
+    __slots__ = (
+        # Connection
+        'server', 'transport', 'inbuffer', 'receive_buffer', 'parser', 'read_timer', 'read_phase',
+        'write_timer', 'requests_served', 'processing', 'busy', 'producer_fifo', 'writer',
+        'drain_waiter', 'server_name', 'server_port', 'metrics_only',
+        # Current request
+        'reading_headers', 'headers', 'request_body', 'chunked', 'content_length', 'path', 'response',
+        'method', 'request_version', 'close_connection', 'request_start', 'bytes_sent', 'route',
+        'status_code',
+    )
+
+    # Whether multipart/form-data bodies are split into parts on arrival.
+    split_multipart = True
+
+    def __init__(self, server):
+        self.server = server
+        self.transport = None
+        self.inbuffer = bytearray()
+        self.receive_buffer = None
+        self.parser = RequestParser(max_header_size=server.max_header_size, max_headers=server.max_headers)
+        self.read_timer = None
+        self.read_phase = None
+        self.write_timer = None
+        self.requests_served = 0
+        self.processing = False
+        self.busy = False
+        # A list; it rarely holds more than a few items.
+        self.producer_fifo = []
+        self.writer = None
+        self.drain_waiter = None
+        self.server_name = server.host
+        self.server_port = server.port
+        self.request_body = None
+        # Set on connections accepted by the metrics listener.
+        self.metrics_only = False
+        self.reset()
+
+    def reset(self):
+        self.parser.reset()
         self.reading_headers = True
-        self.headers = {}
+        self.headers = EMPTY_HEADERS
+        if self.request_body is not None:
+            self.request_body.close()
+        self.request_body = None
+        self.chunked = None
+        self.content_length = 0
         self.path = ''
-        self.response = ''
+        self.response = ()
         self.method = ''
-        self.limiter = ''
-        self.server_name = 'localhost'
-        self.server_port = 9000
+        self.request_version = 'HTTP/1.0'
+        self.close_connection = True
+        self.request_start = None
+        self.bytes_sent = 0
+        self.route = 'other'
+        self.status_code = None
 
-    def collect_incoming_data(self, data):
-        logging.debug(f"Incoming data: {data}")
-        self.ibuffer += data.decode('utf-8')
+    def connection_made(self, transport):
+        self.transport = transport
+        self.server.connections.add(self)
+        if self.server.metrics is not None:
+            self.server.metrics.connections_total += 1
+        transport.set_write_buffer_limits(high=self.server.write_buffer_limit)
+        if self.server.sample_debug():
+            logging.debug(f"Incoming connection from {transport.get_extra_info('peername')}")
+        self.set_read_timeout('idle')
 
-    def found_terminator(self):
-        self.parse_request()
+    def connection_lost(self, exc):
+        self.cancel_read_timeout()
+        self.cancel_write_timeout()
+        self.transport = None
+        if self.writer is not None:
+            self.writer.cancel()
+        self.discard_buffers()
+        if self.request_body is not None:
+            self.request_body.close()
+        self.resume_writing()
+        self.server.connection_closed(self)
 
-    def parse_request(self):
-        self.reading_headers = False
-        if 'method' not in self.headers:
-            self.method, self.path, self.ibuffer = self.ibuffer.split(' ', 2)
-        self.parse_headers()
-        if 'method' not in self.headers:
-            self.send_error(400)
-        if self.headers['method'] == "POST":
-            try:
-                if not self.limiter:
-                    self.ibuffer = ''
-                    self.limiter = self.headers['content-type'][
-                                   self.headers['content-type'].index('boundary=') + 9:]
-                    content_length = self.headers['content-length']
-                    if int(content_length) == 0:
-                        self.send_error(400)
-                    self.set_terminator(int(content_length))
-                    self.reading_headers = True
+    def shutdown(self):
+        """Close now if idle between requests, else after the current one."""
+        if self.read_phase == 'idle' and not self.inbuffer:
+            self.close()
+
+    def pause_writing(self):
+        if self.drain_waiter is None:
+            self.drain_waiter = asyncio.get_running_loop().create_future()
+        self.transport.pause_reading()
+        self.start_write_timeout()
+
+    def resume_writing(self):
+        self.cancel_write_timeout()
+        if self.drain_waiter is not None:
+            if not self.drain_waiter.done():
+                self.drain_waiter.set_result(None)
+            self.drain_waiter = None
+        if self.transport is not None:
+            self.transport.resume_reading()
+            self.process_input()
+
+    async def drain(self):
+        if self.transport is None:
+            raise ConnectionResetError("Connection lost")
+        if self.drain_waiter is not None:
+            await self.drain_waiter
+
+    def set_read_timeout(self, phase):
+        """Arm the timeout for what the connection is waiting to read.
+
+        ``idle`` is the keep-alive wait for the next request, ``header``
+        runs from its first byte to the end of the head however the bytes
+        trickle in, and ``body`` is restarted whenever body data arrives.
+        """
+        self.cancel_read_timeout()
+        self.read_phase = phase
+        timeout = {
+            'idle': self.server.keepalive_timeout,
+            'header': self.server.header_timeout,
+            'body': self.server.body_timeout,
+        }[phase]
+        if timeout:
+            self.read_timer = self.server.timers.schedule(timeout, self.handle_read_timeout)
+
+    def cancel_read_timeout(self):
+        self.read_phase = None
+        if self.read_timer is not None:
+            self.read_timer.cancel()
+            self.read_timer = None
+
+    def handle_read_timeout(self):
+        self.read_timer = None
+        if self.drain_waiter is not None:
+            # Reading is paused until the client takes its response, which
+            # is the write timeout's business.
+            self.set_read_timeout(self.read_phase)
+            return
+        if self.read_phase == 'idle':
+            logging.debug("Closing idle connection")
+            self.close()
+        else:
+            logging.debug(f"Timed out reading the request {self.read_phase}")
+            self.close_connection = True
+            self.read_phase = None
+            self.send_error(408)
+
+    def start_write_timeout(self):
+        if self.server.write_timeout and self.write_timer is None:
+            self.write_timer = self.server.timers.schedule(self.server.write_timeout, self.handle_write_timeout)
+
+    def cancel_write_timeout(self):
+        if self.write_timer is not None:
+            self.write_timer.cancel()
+            self.write_timer = None
+
+    def handle_write_timeout(self):
+        logging.debug("Client stopped reading the response")
+        self.write_timer = None
+        if self.writer is not None:
+            # Out of sendfile first; the transport can't abort under it.
+            self.writer.cancel()
+        if self.transport is not None:
+            self.transport.abort()
+
+    def get_buffer(self, sizehint):
+        self.receive_buffer = self.server.buffers.acquire()
+        return self.receive_buffer
+
+    def buffer_updated(self, nbytes):
+        buffer, self.receive_buffer = self.receive_buffer, None
+        with memoryview(buffer) as view:
+            self.data_received(view[:nbytes])
+        self.server.buffers.release(buffer)
+
+    def data_received(self, data):
+        if self.read_phase == 'idle':
+            self.set_read_timeout('header')
+        elif self.read_phase == 'body':
+            self.set_read_timeout('body')
+        self.inbuffer += data
+        self.process_input()
+
+    def process_input(self):
+        """Parse buffered input and dispatch complete requests.
+
+        Stops while a response is still being streamed (``busy``) so that
+        pipelined requests are only parsed once the previous one is done,
+        and while writing is paused, so a client that doesn't read can't
+        pile up responses; ``resume_writing`` carries on from there.
+        """
+        if self.processing:
+            return
+        self.processing = True
+        try:
+            while (self.inbuffer and not self.busy and self.drain_waiter is None
+                   and self.transport is not None and not self.transport.is_closing()):
+                try:
+                    if self.reading_headers:
+                        head = self.parser.parse(self.inbuffer)
+                        if head is None:
+                            break
+                        self.method, self.path, self.request_version, self.headers, consumed = head
+                        del self.inbuffer[:consumed]
+                        self.found_headers()
+                    elif self.chunked is not None:
+                        data, consumed = self.chunked.feed(self.inbuffer)
+                        if not consumed:
+                            break
+                        del self.inbuffer[:consumed]
+                        self.collect_incoming_data(data)
+                        if self.chunked.done:
+                            self.found_body()
+                    else:
+                        needed = self.content_length - self.request_body.size
+                        data = bytes(self.inbuffer[:needed])
+                        del self.inbuffer[:needed]
+                        self.collect_incoming_data(data)
+                        if self.request_body.size == self.content_length:
+                            self.found_body()
+                except HTTPParseError as e:
+                    logging.debug(f"Bad request: {e}")
+                    self.send_error(e.code)
+                    break
+        finally:
+            self.processing = False
+
+    def end_request(self):
+        """Mark the response as complete.
+
+        If queued output is still being written, the connection stays busy
+        and ``write_producers`` finishes the request once it has drained.
+        """
+        self.requests_served += 1
+        if self.writer is not None:
+            self.busy = True
+            return
+        self.request_done()
+
+    def request_done(self):
+        """Close the connection or get ready for the next request."""
+        self.busy = False
+        self.record_request()
+        self.log_request()
+        if self.close_connection or self.server.stopping:
+            self.close()
+            return
+        self.reset()
+        if self.inbuffer:
+            self.set_read_timeout('header')
+            self.process_input()
+        else:
+            self.set_read_timeout('idle')
+
+    def record_request(self):
+        metrics = self.server.metrics
+        if metrics is not None and self.request_start is not None and self.status_code is not None:
+            metrics.observe(self.route, self.status_code, time.monotonic() - self.request_start)
+
+    def log_request(self):
+        access_log = self.server.access_log
+        if access_log is None or self.request_start is None or self.status_code is None:
+            return
+        peer = self.transport.get_extra_info('peername') if self.transport is not None else None
+        access_log.log(peer[0] if peer else None, self.method, self.path, self.request_version,
+                       self.status_code, self.bytes_sent, time.monotonic() - self.request_start)
+
+    def push(self, data):
+        """Queue bytes for output without writing them yet."""
+        self.producer_fifo.append(data)
+
+    def push_with_producer(self, producer):
+        """Queue an object whose ``more()`` returns body chunks until b''.
+
+        ``more()`` may also return an awaitable of the chunk, for producers
+        that compute it off the event loop.
+        """
+        self.producer_fifo.append(producer)
+
+    def send(self, data):
+        self.push(data)
+        self.initiate_send()
+
+    def send_file(self, fp, offset, count):
+        """Queue ``count`` bytes of ``fp`` starting at ``offset``.
+
+        The file is sent with ``os.sendfile`` when the loop supports it
+        and is closed once written.
+        """
+        self.push_with_producer(FileProducer(fp, offset=offset, count=count))
+        self.initiate_send()
+
+    def initiate_send(self):
+        """Start writing queued output.
+
+        Byte strings at the head of the queue go out in one ``writelines``
+        call, which becomes a single scatter-gather ``sendmsg`` on
+        transports that support it.  Before Python 3.12 ``writelines``
+        copies everything into one string, so ``write_buffers`` writes large
+        bodies separately instead.  Anything from the first producer on
+        is left to the ``write_producers`` task, which waits for write
+        readiness between chunks.
+        """
+        if self.writer is not None or self.transport is None:
+            return
+        count = 0
+        for item in self.producer_fifo:
+            if not isinstance(item, BYTES_TYPES):
+                break
+            count += 1
+        buffers = self.producer_fifo[:count]
+        del self.producer_fifo[:count]
+        if buffers:
+            self.bytes_sent += sum(map(len, buffers))
+            if WRITELINES_GATHERS or len(buffers) == 1:
+                self.transport.writelines(buffers)
+            else:
+                self.write_buffers(buffers)
+        if self.producer_fifo:
+            self.writer = asyncio.get_running_loop().create_task(self.write_producers())
+
+    def write_buffers(self, buffers):
+        """Write ``buffers``, joining the small ones but not copying large ones."""
+        joined = []
+        for buffer in buffers:
+            if len(buffer) < JOIN_LIMIT:
+                joined.append(buffer)
+                continue
+            if joined:
+                self.transport.write(b''.join(joined))
+                joined = []
+            self.transport.write(buffer)
+        if joined:
+            self.transport.write(b''.join(joined))
+
+    async def write_producers(self):
+        try:
+            while self.producer_fifo:
+                await self.drain()
+                item = self.producer_fifo[0]
+                if isinstance(item, BYTES_TYPES):
+                    self.bytes_sent += len(item)
+                    self.transport.write(item)
+                elif isinstance(item, FileProducer):
+                    await self.write_file(item)
                 else:
-                    self.obuffer = self.ibuffer[
-                                   self.ibuffer.index('\r\n\r\n') + 4:self.ibuffer.find('--' + self.limiter + '--') - 2]
-                    self.handle_request()
-            except KeyError or ValueError:
+                    await self.write_producer(item)
+                self.producer_fifo.pop(0)
+        except (ConnectionError, RuntimeError) as e:
+            logging.debug(f"Response aborted: {e}")
+            self.writer = None
+            self.close()
+            return
+        except Exception:
+            logging.exception("Error while producing response")
+            self.writer = None
+            self.close()
+            return
+        self.writer = None
+        if self.busy:
+            self.request_done()
+
+    async def write_producer(self, producer):
+        while True:
+            data = producer.more()
+            if inspect.isawaitable(data):
+                data = await data
+            if not data:
+                break
+            await self.drain()
+            self.bytes_sent += len(data)
+            self.transport.write(data)
+
+    async def write_file(self, producer):
+        loop = asyncio.get_running_loop()
+        offset = producer.offset if producer.offset is not None else producer.file.tell()
+        if producer.remaining is None:
+            producer.remaining = max(os.fstat(producer.file.fileno()).st_size - offset, 0)
+        try:
+            while producer.remaining:
+                # Sent in segments so a client that stops reading runs into
+                # the write timeout.
+                self.start_write_timeout()
+                try:
+                    sent = await loop.sendfile(self.transport, producer.file, offset,
+                                               min(producer.remaining, SENDFILE_SEGMENT), fallback=False)
+                finally:
+                    self.cancel_write_timeout()
+                if not sent:
+                    break
+                self.bytes_sent += sent
+                offset += sent
+                producer.offset = offset
+                producer.remaining -= sent
+        except (asyncio.SendfileNotAvailableError, NotImplementedError):
+            # uvloop doesn't implement loop.sendfile at all.
+            await self.write_producer(producer)
+        finally:
+            producer.close()
+
+    def discard_buffers(self):
+        while self.producer_fifo:
+            item = self.producer_fifo.pop(0)
+            if hasattr(item, 'close'):
+                item.close()
+
+    def should_keep_alive(self):
+        if self.server.stopping or self.requests_served + 1 >= self.server.keepalive_requests:
+            return False
+        connection = {token.strip() for token in self.headers.get('connection', '').lower().split(',')}
+        if self.request_version == 'HTTP/1.1':
+            return 'close' not in connection
+        return 'keep-alive' in connection
+
+    def connection_header(self):
+        return "close" if self.close_connection else "keep-alive"
+
+    def close(self):
+        if self.transport is not None:
+            self.transport.close()
+
+    def handle_close(self):
+        self.close()
+
+    def collect_incoming_data(self, data):
+        if self.request_body.size + len(data) > self.server.max_body_size:
+            raise HTTPParseError(413)
+        self.request_body.write(data)
+
+    def found_headers(self):
+        if self.server.sample_debug():
+            logging.debug(f"Request: {self.method} {self.path} {self.request_version}")
+        self.reading_headers = False
+        self.cancel_read_timeout()
+        self.request_start = time.monotonic()
+        self.close_connection = not self.should_keep_alive()
+        if self.metrics_only:
+            # Scrapes don't send bodies; closing spares framing them.
+            self.close_connection = True
+            self.send_metrics()
+            return
+        transfer_encoding = self.headers.get('transfer-encoding')
+        if transfer_encoding is not None:
+            if transfer_encoding.strip().lower() != 'chunked':
+                # Only chunked bodies are decoded; anything layered on
+                # top would be passed on still encoded.
+                self.send_error(501)
+                return
+            if 'content-length' in self.headers:
+                # Ambiguous framing is a request smuggling vector.
                 self.send_error(400)
                 return
+            self.chunked = ChunkedDecoder()
         else:
-            self.ibuffer = ''
-            self.handle_request()
+            self.content_length = int(self.headers.get('content-length', 0))
+            if self.content_length > self.server.max_body_size:
+                self.send_error(413)
+                return
+        if self.chunked is None and not self.content_length:
+            self.request_body = self.empty_request_body()
+            if self.server.metrics_path is not None and self.path.partition('?')[0] == self.server.metrics_path:
+                self.send_metrics()
+                return
+            self.found_body()
+            return
+        self.request_body = self.create_request_body()
+        self.set_read_timeout('body')
+        if self.headers.get('expect', '').lower() == '100-continue':
+            self.transport.write(b"HTTP/1.1 100 Continue\r\n\r\n")
 
-    def parse_headers(self):
-        key_value_strings = self.ibuffer.split('\r\n')
-        for key_value in key_value_strings:
-            if ':' not in key_value:
-                continue
-            else:
-                key, value = key_value.split(':', 1)
-                value.lstrip()
-                self.headers[key.lower()] = value
-        self.headers['method'] = self.method
+    def create_request_body(self):
+        """Return the object the request body is written into as it arrives."""
+        content_type = self.headers.get('content-type') if self.split_multipart else None
+        return RequestBody(content_type, self.server.spool_threshold)
+
+    def empty_request_body(self):
+        """Return the body of a request that doesn't have one."""
+        return EMPTY_BODY
+
+    def found_body(self):
+        self.cancel_read_timeout()
+        self.request_body.finish()
+        self.handle_request()
 
     def handle_request(self):
-        method_name = 'do_' + self.headers['method']
+        method_name = 'do_' + self.method
         if not hasattr(self, method_name):
             self.send_error(405)
-            self.handle_close()
             return
         handler = getattr(self, method_name)
         handler()
 
-    def add_header(self, keyword, value):
-        self.response += f"{keyword}: {value}"
+    def send_metrics(self):
+        """Answer with the server metrics in the Prometheus text format."""
+        self.route = 'metrics'
+        if self.method not in ('GET', 'HEAD'):
+            self.send_error(405)
+            return
+        if self.metrics_only and self.server.metrics_path not in (None, self.path.partition('?')[0]):
+            self.send_error(404)
+            return
+        body = self.server.metrics.render().encode('utf-8')
+        self.init_response(200, "OK")
+        self.add_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.add_header("Content-Length", len(body))
+        self.add_raw_header(self.server.clock.header)
+        self.add_raw_header(SERVER_HEADER)
+        self.add_connection_header()
         self.end_headers()
+        self.push(self.response_head())
+        if self.method != "HEAD":
+            self.push(body)
+        self.initiate_send()
+        self.end_request()
+
+    def add_header(self, keyword, value):
+        self.response.append(header_line(keyword, value))
+
+    def add_raw_header(self, line):
+        """Add an already encoded header line, CRLF included."""
+        self.response.append(line)
+
+    def add_connection_header(self):
+        self.response.append(CONNECTION_HEADERS[self.close_connection])
 
     def send_error(self, code, message=None):
         try:
@@ -159,84 +1000,400 @@ class AsyncHTTPRequestHandler(asynchat.async_chat):
             short_msg, long_msg = '???', '???'
         if message is None:
             message = short_msg
+        if self.route == 'other':
+            self.route = 'error'
+        if code in (400, 408, 413, 414, 431, 501):
+            # The request couldn't be framed, so the stream can't be
+            # trusted for another one.
+            self.close_connection = True
 
+        body = long_msg + "\r\n"
         self.init_response(code, message)
         self.add_header("Content-Type", "text/plain")
-        self.add_header("Connection", "close")
+        self.add_header("Content-Length", len(body.encode('utf-8')))
+        self.add_connection_header()
         self.end_headers()
-        self.response += long_msg
-        self.end_headers()
-        self.send(self.response.encode('utf-8'))
-        self.close()
+        self.response.append(body.encode('utf-8'))
+        self.send(self.response_head())
+        self.end_request()
 
     def init_response(self, code, message=None):
-        self.response = f"HTTP/1.1 {code} {message}"
-        self.end_headers()
+        """Start the response head in ``response``, a list of encoded lines."""
+        self.status_code = int(code)
+        self.response = [status_line(code, message)]
 
     def end_headers(self):
-        self.response += "\r\n"
+        self.response.append(b"\r\n")
+
+    def response_head(self):
+        return b"".join(self.response)
 
     def date_time_string(self):
-        return strftime("%a, %d %b %Y %H:%M:%S GMT", gmtime())
-
-    def send_head(self):
-        path = os.getcwd() + url_normalize(self.path)
-        if os.path.isdir(path):
-            path = os.path.join(path, "index.html")
-            if not os.path.isfile(path):
-                self.send_error(403)
-                return None
-            file_type, _ = mimetypes.guess_type(path)
-            file = read_file(path)
-        elif os.path.isfile(path):
-            file_type, _ = mimetypes.guess_type(path)
-            file = read_file(path)
+        return self.server.clock.text
+
+    def send_head(self, key):
+        """Find the file the normalized path ``key`` names.
+
+        Returns its ``Resolved`` entry, or None once an error response has
+        been sent.  The file isn't opened here: its stat results are cached
+        by the resolver, which is all a conditional request needs.
+        """
+        target = self.static_resolver(key)
+        if target is None:
+            self.send_error(404)
+            return None
+        resolver, path = target
+        resolved = resolver.resolve(path)
+        if resolved.kind != 'file':
+            self.send_error(403 if resolved.kind == 'forbidden' else 404)
+            return None
+        return resolved
+
+    def static_resolver(self, key):
+        """The ``PathResolver`` and path to look up the normalized ``key`` with.
+
+        Returns None if no files are served under ``key``.
+        """
+        return self.server.resolver, key
+
+    def static_headers(self, entry):
+        """Encoded status line and request-independent headers of a 200 for ``entry``."""
+        headers = (f"Content-Type: {entry.file_type}\r\n"
+                   f"Content-Length: {entry.size}\r\n"
+                   f"ETag: {entry.etag}\r\n"
+                   f"Last-Modified: {entry.last_modified}\r\n")
+        if entry.encoding is not None:
+            headers += f"Content-Encoding: {entry.encoding}\r\n"
         else:
+            headers += "Accept-Ranges: bytes\r\n"
+        if entry.vary:
+            headers += "Vary: Accept-Encoding\r\n"
+        return status_line(200, "OK") + SERVER_HEADER + headers.encode('latin-1')
+
+    def find_encodings(self, entry, sidecars):
+        """Record the precompressed ``sidecars`` of ``entry`` and whether it varies."""
+        entry.sidecars = sidecars
+        compressed_cache = self.server.compressed_cache
+        entry.vary = bool(entry.sidecars) or (
+            compressed_cache is not None and compressed_cache.worth_compressing(entry.file_type, entry.size))
+
+    def file_entry(self, path, body, file_type, stat, sidecars):
+        entry = CachedFile(path, body, file_type, stat)
+        self.find_encodings(entry, sidecars)
+        entry.header_block = self.static_headers(entry)
+        return entry
+
+    def static_file(self):
+        """Find the file for the request, through the file cache if enabled.
+
+        Returns a ``CachedFile``, which holds the body if the file cache
+        does, or None once an error response has been sent.
+        """
+        cache = self.server.file_cache
+        key = url_normalize(self.path)
+        if key is None:
             self.send_error(404)
             return None
-        return file, file_type
+        if cache is not None:
+            entry = cache.get(key)
+            if entry is not None:
+                self.route = 'static_hit'
+                return entry
+        self.route = 'static_miss'
+        resolved = self.send_head(key)
+        if resolved is None:
+            return None
+        if cache is None or not cache.cacheable(resolved.stat.st_size):
+            return self.file_entry(resolved.path, None, resolved.file_type, resolved.stat, resolved.sidecars)
+        try:
+            with open(resolved.path, 'rb') as fp:
+                stat = os.fstat(fp.fileno())
+                body = fp.read(stat.st_size)
+        except OSError as e:
+            self.send_error(404 if isinstance(e, FileNotFoundError) else 403)
+            return None
+        entry = self.file_entry(resolved.path, body, resolved.file_type, stat, resolved.sidecars)
+        cache.put(key, entry)
+        return entry
+
+    def encoded_variant(self, entry):
+        """Pick the best content-coding the client accepts for ``entry``.
+
+        A precompressed sidecar wins; otherwise compressible files are
+        compressed once in a pool thread and kept in the server's
+        compressed cache, and sent as is until then.  Returns the variant,
+        or None to send the file as is.  Range requests are always answered
+        from the identity encoding.
+        """
+        accept_encoding = self.headers.get('accept-encoding')
+        if not entry.vary or not accept_encoding or 'range' in self.headers:
+            return None
+        codings = compression.parse_accept_encoding(accept_encoding)
+        compressed_cache = self.server.compressed_cache
+        for encoding in compression.ENCODINGS:
+            if not compression.accepts(codings, encoding):
+                continue
+            key = (entry.etag, encoding)
+            if compressed_cache is not None and key in compressed_cache:
+                variant = compressed_cache.get(key)
+                if variant is None:
+                    continue
+                return variant
+            sidecar = entry.sidecars.get(encoding)
+            if sidecar is not None:
+                path, stat = sidecar
+                variant = entry.variant(encoding, path=path, size=stat.st_size)
+            elif (compressed_cache is not None and compression.available(encoding)
+                  and compressed_cache.worth_compressing(entry.file_type, entry.size)):
+                # Compressing takes too long for the loop; this response
+                # goes out as is, later ones get the cached variant.
+                self.compress_later(entry, key, encoding)
+                return None
+            else:
+                continue
+            variant.header_block = self.static_headers(variant)
+            if compressed_cache is not None:
+                compressed_cache.put(key, variant)
+            return variant
+        return None
+
+    def compress_later(self, entry, key, encoding):
+        """Compress ``entry`` in a pool thread and cache the variant under ``key``."""
+        compressed_cache = self.server.compressed_cache
+        if key in compressed_cache.pending:
+            return
+        compressed_cache.pending.add(key)
+        future = self.server.loop.run_in_executor(None, compression.compress_file,
+                                                  entry.body, entry.path, entry.size, encoding)
+        future.add_done_callback(functools.partial(self.compressed, entry, key, encoding))
+
+    def compressed(self, entry, key, encoding, future):
+        compressed_cache = self.server.compressed_cache
+        compressed_cache.pending.discard(key)
+        if future.cancelled():
+            return
+        if future.exception() is not None:
+            logging.warning(f"Can't compress {entry.path}: {future.exception()!r}")
+            return
+        body = future.result()
+        if body is None:
+            compressed_cache.put(key, None)
+            return
+        variant = entry.variant(encoding, body=body)
+        variant.header_block = self.static_headers(variant)
+        compressed_cache.put(key, variant)
+
+    def not_modified(self, entry):
+        """Evaluate If-None-Match / If-Modified-Since against ``entry``."""
+        if_none_match = self.headers.get('if-none-match')
+        if if_none_match is not None:
+            if if_none_match.strip() == '*':
+                return True
+            tags = (tag.strip() for tag in if_none_match.split(','))
+            return entry.etag in (tag[2:] if tag.startswith('W/') else tag for tag in tags)
+        if_modified_since = self.headers.get('if-modified-since')
+        if if_modified_since is not None:
+            try:
+                since = parsedate_to_datetime(if_modified_since).timestamp()
+            except (TypeError, ValueError):
+                return False
+            return entry.modified_seconds <= since
+        return False
+
+    def send_not_modified(self, entry):
+        self.init_response(304, "Not Modified")
+        self.add_raw_header(self.server.clock.header)
+        self.add_raw_header(SERVER_HEADER)
+        self.add_header("ETag", entry.etag)
+        self.add_header("Last-Modified", entry.last_modified)
+        if entry.vary:
+            self.add_header("Vary", "Accept-Encoding")
+        self.add_connection_header()
+        self.end_headers()
+        self.send(self.response_head())
+        self.end_request()
+
+    def requested_ranges(self, entry):
+        """Byte ranges to serve, or None for the whole file.
+
+        ``If-Range`` only lets the ranges through if it names the current
+        strong ETag or the exact Last-Modified date.
+        """
+        range_header = self.headers.get('range')
+        if range_header is None:
+            return None
+        if_range = self.headers.get('if-range')
+        if if_range is not None and if_range not in (entry.etag, entry.last_modified):
+            return None
+        return parse_range(range_header, entry.size)
+
+    def send_range_not_satisfiable(self, entry):
+        self.init_response(416, "Range Not Satisfiable")
+        self.add_raw_header(self.server.clock.header)
+        self.add_raw_header(SERVER_HEADER)
+        self.add_header("Content-Range", f"bytes */{entry.size}")
+        self.add_header("Content-Length", 0)
+        self.add_connection_header()
+        self.end_headers()
+        self.send(self.response_head())
+        self.end_request()
+
+    def send_partial(self, entry, fp, ranges):
+        """Send a 206 with one range, or several as multipart/byteranges.
+
+        Only the selected windows are read: cached bodies are sliced through
+        a memoryview and files are sent segment by segment.
+        """
+        if len(ranges) == 1:
+            start, end = ranges[0]
+            parts = [(b'', start, end)]
+            content_type = entry.file_type
+            trailer = b''
+        else:
+            boundary = secrets.token_hex(16)
+            parts = [(f"\r\n--{boundary}\r\n"
+                      f"Content-Type: {entry.file_type}\r\n"
+                      f"Content-Range: bytes {start}-{end}/{entry.size}\r\n\r\n".encode('utf-8'), start, end)
+                     for start, end in ranges]
+            content_type = f"multipart/byteranges; boundary={boundary}"
+            trailer = f"\r\n--{boundary}--\r\n".encode('utf-8')
+        length = sum(len(head) + end - start + 1 for head, start, end in parts) + len(trailer)
+
+        self.init_response(206, "Partial Content")
+        self.add_header("Content-Type", content_type)
+        self.add_header("Content-Length", length)
+        if len(ranges) == 1:
+            self.add_header("Content-Range", f"bytes {ranges[0][0]}-{ranges[0][1]}/{entry.size}")
+        self.add_raw_header(self.server.clock.header)
+        self.add_raw_header(SERVER_HEADER)
+        self.add_header("ETag", entry.etag)
+        self.add_header("Last-Modified", entry.last_modified)
+        self.add_header("Accept-Ranges", "bytes")
+        if entry.vary:
+            self.add_header("Vary", "Accept-Encoding")
+        self.add_connection_header()
+        self.end_headers()
+        self.push(self.response_head())
+        if self.method != "HEAD":
+            body = memoryview(entry.body) if fp is None else None
+            for index, (head, start, end) in enumerate(parts):
+                if head:
+                    self.push(head)
+                if body is not None:
+                    self.push(body[start:end + 1])
+                else:
+                    # Each segment gets its own descriptor so closing one
+                    # producer doesn't close the file under the next.
+                    part_fp = fp if index == len(parts) - 1 else os.fdopen(os.dup(fp.fileno()), 'rb')
+                    self.send_file(part_fp, start, end - start + 1)
+            if trailer:
+                self.push(trailer)
+        elif fp is not None:
+            fp.close()
+        self.initiate_send()
+        self.end_request()
+
+    def send_static(self, entry, fp):
+        # Everything but Date and Connection was encoded with the entry.
+        self.status_code = 200
+        self.push(b"".join((entry.header_block, self.server.clock.header,
+                            CONNECTION_HEADERS[self.close_connection], b"\r\n")))
+        if self.method == "HEAD":
+            if fp is not None:
+                fp.close()
+        elif fp is None:
+            self.push(entry.body)
+        else:
+            self.send_file(fp, 0, entry.size)
+        self.initiate_send()
+        self.end_request()
 
     def do_GET(self):
-        try:
-            file, file_type = self.send_head()
-            self.init_response(200, "OK")
-            self.add_header("Content-Type", file_type)
-            self.add_header("Date", self.date_time_string())
-            self.add_header("Server", '127.0.0.1')
-            self.add_header("Content-Length", len(file))
-            self.add_header("Connection", "close")
-            self.end_headers()
-            print(self.response.encode('utf-8') + file)
-            self.send(self.response.encode('utf-8') + file)
-            self.close()
-        except TypeError:
-            pass
+        entry = self.static_file()
+        if entry is None:
+            return
+        variant = self.encoded_variant(entry)
+        if variant is None or not self.answer_static(variant):
+            self.answer_static(entry)
+
+    def answer_static(self, entry):
+        """Answer the request from ``entry``, the file or an encoded variant.
+
+        Validators and ranges come from the stat results ``entry`` was made
+        from, so 304 and 416 responses cost no file I/O; the file is only
+        opened once a body goes out.  Returns False, with nothing sent, if
+        a variant's file is gone or has changed.
+        """
+        if self.not_modified(entry):
+            self.send_not_modified(entry)
+            return True
+        ranges = self.requested_ranges(entry)
+        if ranges is not None and not ranges:
+            self.send_range_not_satisfiable(entry)
+            return True
+        fp = None
+        if entry.body is None:
+            try:
+                fp = open(entry.path, 'rb')
+            except OSError as e:
+                if entry.encoding is not None:
+                    return False
+                self.send_error(404 if isinstance(e, FileNotFoundError) else 403)
+                return True
+            stat = os.fstat(fp.fileno())
+            if stat.st_size != entry.size or (entry.encoding is None and entry.changed(stat)):
+                # Changed since it was resolved; the resolver's next check
+                # catches up with it.
+                fp.close()
+                if entry.encoding is not None:
+                    return False
+                return self.answer_static(
+                    self.file_entry(entry.path, None, entry.file_type, stat, entry.sidecars))
+        if ranges is None:
+            self.send_static(entry, fp)
+        else:
+            self.send_partial(entry, fp, ranges)
+        return True
 
     def do_HEAD(self):
-        file, file_type = self.send_head()
-        self.init_response(200, "OK")
-        self.add_header("Date", self.date_time_string())
-        self.add_header("Server", '127.0.0.1')
-        self.add_header("Content-Type", file_type)
-        self.add_header("Content-Length", len(file))
-        self.add_header("Connection", "close")
-        self.end_headers()
-        self.send(self.response.encode('utf-8'))
-        self.close()
+        self.do_GET()
 
     def do_POST(self):
+        """Echo the first part of a multipart body, or the whole raw body."""
+        self.route = 'upload'
+        body = self.request_body
+        if not body.size:
+            self.send_error(400)
+            return
+        if body.multipart is not None:
+            if not body.parts:
+                self.send_error(400)
+                return
+            part = body.parts[0]
+            fp, size, content_type = part.file, part.size, part.content_type
+        else:
+            fp, size = body.file, body.size
+            content_type = self.headers.get('content-type', 'application/octet-stream')
         self.init_response(200, "OK")
-        self.add_header("Server", '127.0.0.1')
-        self.add_header("Content-Type", self.headers['content-type'])
-        self.add_header("Connection", "close")
-        self.add_header("Content-Length", self.headers['content-length'])
+        self.add_raw_header(SERVER_HEADER)
+        self.add_header("Content-Type", content_type)
+        self.add_connection_header()
+        self.add_header("Content-Length", size)
         self.end_headers()
-        self.response += self.obuffer
-        self.send(self.response.encode('utf-8'))
-        self.close()
+        self.push(self.response_head())
+        if size > self.server.spool_threshold:
+            self.send_file(fp, 0, size)
+        else:
+            # Still in memory; sendfile would force it out to disk first.
+            self.push(fp.read(size))
+            self.initiate_send()
+        self.end_request()
 
     responses = {
         200: ('OK', 'Request fulfilled, document follows'),
+        206: ('Partial Content', 'Partial content follows'),
+        304: ('Not Modified',
+              'Document has not changed since given time'),
         400: ('Bad Request',
               'Bad request syntax or unsupported method'),
         403: ('Forbidden',
@@ -244,6 +1401,21 @@ class AsyncHTTPRequestHandler(asynchat.async_chat):
         404: ('Not Found', 'Nothing matches the given URI'),
         405: ('Method Not Allowed',
               'Specified method is invalid for this resource.'),
+        408: ('Request Timeout',
+              'Request was not received in time'),
+        413: ('Payload Too Large',
+              'Request body is larger than the server is willing to process'),
+        414: ('Request-URI Too Long', 'URI is too long'),
+        416: ('Range Not Satisfiable',
+              'Cannot satisfy request range'),
+        431: ('Request Header Fields Too Large',
+              'The server refused this request because the request header fields are too large'),
+        500: ('Internal Server Error',
+              'Server got itself in trouble'),
+        503: ('Service Unavailable',
+              'The server cannot process the request due to a high load'),
+        501: ('Not Implemented',
+              'Server does not support this operation'),
     }
 
 
@@ -253,14 +1425,130 @@ def parse_args():
     parser.add_argument("--port", dest="port", type=int, default=9000)
     parser.add_argument("--log", dest="loglevel", default="info")
     parser.add_argument("--logfile", dest="logfile", default=None)
-    parser.add_argument("-w", dest="nworkers", type=int, default=1)
+    parser.add_argument("--access-log", dest="access_log", default=None,
+                        help="file to log requests to, - for stdout")
+    parser.add_argument("--access-log-format", dest="access_log_format", choices=("text", "json"), default="text")
+    parser.add_argument("--debug-sample", dest="debug_sample", type=int, default=1,
+                        help="trace only one in this many connections and requests at debug level")
+    parser.add_argument("--model", dest="model", choices=MODELS, default="async",
+                        help="async: one event loop per process; threads: a pool of event loop threads "
+                             "in one process; prefork-threads: such a pool in every worker process")
+    parser.add_argument("-w", dest="nworkers", type=int, default=None,
+                        help="worker processes, one per CPU by default; 0 serves from the main process")
+    parser.add_argument("--threads", dest="threads", type=int, default=4,
+                        help="event loop threads per process with the threads models")
+    parser.add_argument("--reuse-port", dest="reuse_port", action="store_true",
+                        help="bind a SO_REUSEPORT socket in every worker instead of sharing one")
+    parser.add_argument("--graceful-timeout", dest="graceful_timeout", type=float, default=30.0)
+    parser.add_argument("--loop", dest="loop", choices=LOOPS, default="auto",
+                        help="event loop reactor; auto follows the event loop policy")
     parser.add_argument("-r", dest="document_root", default=".")
-    return parser.parse_args()
+    parser.add_argument("--path-cache-size", dest="path_cache_size", type=int, default=4096,
+                        help="resolved request paths to remember, 0 looks every path up")
+    parser.add_argument("--keepalive-requests", dest="keepalive_requests", type=int, default=100)
+    parser.add_argument("--keepalive-timeout", dest="keepalive_timeout", type=float, default=5.0)
+    parser.add_argument("--header-timeout", dest="header_timeout", type=float, default=10.0,
+                        help="seconds to receive a whole request head")
+    parser.add_argument("--body-timeout", dest="body_timeout", type=float, default=30.0,
+                        help="seconds the request body may stall")
+    parser.add_argument("--write-timeout", dest="write_timeout", type=float, default=30.0,
+                        help="seconds a client may stop reading its response")
+    parser.add_argument("--backlog", dest="backlog", type=int, default=1024)
+    parser.add_argument("--max-connections", dest="max_connections", type=int, default=10000,
+                        help="open connections per worker before answering 503 and pausing accept")
+    parser.add_argument("--write-buffer-limit", dest="write_buffer_limit", type=int, default=65536)
+    parser.add_argument("--max-header-size", dest="max_header_size", type=int, default=65536)
+    parser.add_argument("--max-headers", dest="max_headers", type=int, default=100)
+    parser.add_argument("--max-body-size", dest="max_body_size", type=int, default=10 * 1024 * 1024)
+    parser.add_argument("--spool-threshold", dest="spool_threshold", type=int, default=262144,
+                        help="bytes of an uploaded body or part kept in memory before spilling to disk")
+    parser.add_argument("--cache-size", dest="cache_size", type=int, default=16 * 1024 * 1024,
+                        help="byte budget of the static file cache, 0 disables it")
+    parser.add_argument("--cache-max-file", dest="cache_max_file", type=int, default=1024 * 1024)
+    parser.add_argument("--cache-check-interval", dest="cache_check_interval", type=float, default=1.0)
+    parser.add_argument("--compress-cache-size", dest="compress_cache_size", type=int, default=8 * 1024 * 1024,
+                        help="byte budget for compressed variants, 0 disables on-the-fly compression")
+    parser.add_argument("--compress-min-size", dest="compress_min_size", type=int, default=1024)
+    parser.add_argument("--metrics-path", dest="metrics_path", default=None,
+                        help="serve Prometheus metrics at this path, e.g. /metrics")
+    parser.add_argument("--metrics-port", dest="metrics_port", type=int, default=None,
+                        help="serve Prometheus metrics on this port instead of the public one")
+    args = parser.parse_args()
+    problem = loop_unavailable(args.loop)
+    if problem is not None:
+        parser.error(problem)
+    return args
+
+
+def serve(args, sock=None, metrics_sock=None, metrics_dir=None):
+    access_log = None
+    if args.access_log is not None:
+        access_log = AccessLog(args.access_log, args.access_log_format)
+    if args.model == 'async':
+        make_server(args, sock, metrics_sock, metrics_dir, access_log).serve_forever()
+        return
+    if sock is None and not args.reuse_port:
+        sock = bind_socket(args.host, args.port, backlog=args.backlog)
+
+    def make_thread_server(thread):
+        # Each server closes its socket when done, so it gets a
+        # descriptor of its own.  With --reuse-port every thread binds
+        # one and the kernel balances between them.
+        return make_server(args, sock.dup() if sock is not None else None,
+                           metrics_sock.dup() if metrics_sock is not None else None,
+                           metrics_dir, access_log, thread)
 
+    try:
+        ServerThreads(make_thread_server, args.threads).run()
+    finally:
+        if sock is not None:
+            sock.close()
 
-def run():
-    server = AsyncServer(host=args.host, port=args.port, handler_class=AsyncHTTPRequestHandler)
-    server.serve_forever()
+
+def make_server(args, sock=None, metrics_sock=None, metrics_dir=None, access_log=None, thread=None):
+    """An ``AsyncServer`` configured from the command line.
+
+    Caches aren't shared between threads, so a server running as
+    ``thread`` of a pool gets its share of the cache budgets.
+    """
+    share = 1 if thread is None else args.threads
+    file_cache = None
+    if args.cache_size > 0:
+        file_cache = FileCache(max_bytes=args.cache_size // share, max_file_size=args.cache_max_file,
+                               check_interval=args.cache_check_interval)
+    compressed_cache = None
+    if args.compress_cache_size > 0:
+        compressed_cache = CompressedCache(max_bytes=args.compress_cache_size // share,
+                                           min_size=args.compress_min_size)
+    metrics = None
+    if args.metrics_path is not None or metrics_sock is not None:
+        metrics = Metrics(directory=metrics_dir, thread=thread)
+    return AsyncServer(host=args.host, port=args.port, handler_class=AsyncHTTPRequestHandler,
+                       keepalive_requests=args.keepalive_requests,
+                       keepalive_timeout=args.keepalive_timeout,
+                       header_timeout=args.header_timeout,
+                       body_timeout=args.body_timeout,
+                       write_timeout=args.write_timeout,
+                       write_buffer_limit=args.write_buffer_limit,
+                       document_root=args.document_root,
+                       path_cache_size=args.path_cache_size,
+                       file_cache=file_cache,
+                       compressed_cache=compressed_cache,
+                       max_header_size=args.max_header_size,
+                       max_headers=args.max_headers,
+                       max_body_size=args.max_body_size,
+                       spool_threshold=args.spool_threshold,
+                       sock=sock,
+                       reuse_port=args.reuse_port,
+                       backlog=args.backlog,
+                       max_connections=args.max_connections,
+                       graceful_timeout=args.graceful_timeout,
+                       loop=args.loop,
+                       access_log=access_log,
+                       debug_sample=args.debug_sample,
+                       metrics=metrics,
+                       metrics_path=args.metrics_path,
+                       metrics_sock=metrics_sock)
 
 
 if __name__ == "__main__":
@@ -272,7 +1560,23 @@ if __name__ == "__main__":
         format="%(name)s: %(process)d %(message)s")
     log = logging.getLogger(__name__)
 
-    DOCUMENT_ROOT = args.document_root
-    for _ in range(args.nworkers):
-        p = multiprocessing.Process(target=run)
-        p.start()
+    raise_fd_limit()
+    metrics_sock = None
+    if args.metrics_port is not None:
+        metrics_sock = bind_socket(args.host, args.metrics_port)
+    prefork = args.nworkers != 0 and args.model != 'threads'
+    # Workers and threads leave snapshots here so any of them can answer for all.
+    metrics_dir = None
+    if (args.metrics_path is not None or metrics_sock is not None) and (prefork or args.model != 'async'):
+        metrics_dir = tempfile.mkdtemp(prefix='metrics-')
+    try:
+        if not prefork:
+            serve(args, metrics_sock=metrics_sock, metrics_dir=metrics_dir)
+        else:
+            sock = None if args.reuse_port else bind_socket(args.host, args.port, backlog=args.backlog)
+            master = Master(functools.partial(serve, args, metrics_sock=metrics_sock, metrics_dir=metrics_dir),
+                            sock=sock, nworkers=args.nworkers, graceful_timeout=args.graceful_timeout)
+            master.run()
+    finally:
+        if metrics_dir is not None:
+            shutil.rmtree(metrics_dir, ignore_errors=True)
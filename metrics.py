@@ -0,0 +1,220 @@
+import bisect
+import json
+import logging
+import os
+import time
+
+
+# Upper bounds in seconds; the last bucket is +Inf.
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+GAUGES = (
+    ('open_connections', "Connections currently open."),
+    ('output_buffered_bytes', "Response bytes waiting in transport buffers."),
+    ('loop_lag_seconds', "How late the last periodic loop timer fired."),
+)
+
+# Summed over the workers.
+CACHE_COUNTERS = (
+    ('hits', "Lookups answered from the cache."),
+    ('misses', "Lookups the cache couldn't answer."),
+    ('evictions', "Entries dropped to make room."),
+)
+
+# Reported per worker.
+CACHE_GAUGES = (
+    ('entries', "Entries held."),
+    ('bytes', "Bytes of file bodies held."),
+)
+
+
+class Histogram(object):
+    """Fixed-bucket histogram; ``counts`` are per bucket, not cumulative."""
+
+    def __init__(self, counts=None, total=0.0):
+        self.counts = counts or [0] * (len(BUCKETS) + 1)
+        self.sum = total
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+
+    def merge(self, other):
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.sum += other.sum
+
+
+class Metrics(object):
+    """Request histograms and server gauges for one worker process.
+
+    Requests are recorded by route class (``static_hit``, ``static_miss``,
+    ``upload``, ``wsgi``, ``asgi``, ``error``, ...) and status code.  When
+    ``directory`` is set every worker writes a snapshot there once per
+    ``interval`` seconds, and ``render`` adds up the snapshots of all live
+    workers, so whichever worker answers a scrape reports for the pool.
+    Servers running in threads of one process pass their ``thread``
+    number to tell their snapshots apart.
+    """
+
+    def __init__(self, directory=None, interval=1.0, thread=None):
+        self.directory = directory
+        self.interval = interval
+        self.thread = thread
+        self.pid = os.getpid()
+        self.worker = self.worker_name()
+        self.requests = {}
+        self.connections_total = 0
+        self.loop_lag = 0.0
+        self.server = None
+        self.tick = None
+
+    def observe(self, route, code, seconds):
+        key = (route, code)
+        histogram = self.requests.get(key)
+        if histogram is None:
+            histogram = self.requests[key] = Histogram()
+        histogram.observe(seconds)
+
+    def start(self, server):
+        """Begin sampling loop lag and publishing snapshots for ``server``."""
+        self.server = server
+        self.pid = os.getpid()
+        self.worker = self.worker_name()
+        self.tick = time.monotonic()
+        server.loop.call_later(self.interval, self.sample)
+
+    def worker_name(self):
+        return str(self.pid) if self.thread is None else f"{self.pid}.{self.thread}"
+
+    def sample(self):
+        now = time.monotonic()
+        # How late the timer fired is how long the loop was busy.
+        self.loop_lag = max(0.0, now - self.tick - self.interval)
+        self.tick = now
+        if self.directory is not None:
+            self.publish()
+        if self.server.loop is not None and not self.server.loop.is_closed():
+            self.server.loop.call_later(self.interval, self.sample)
+
+    def gauges(self):
+        connections = self.server.connections if self.server is not None else ()
+        buffered = 0
+        for connection in connections:
+            if connection.transport is not None:
+                buffered += connection.transport.get_write_buffer_size()
+        return {
+            'open_connections': len(connections),
+            'output_buffered_bytes': buffered,
+            'loop_lag_seconds': self.loop_lag,
+        }
+
+    def snapshot(self):
+        return {
+            'pid': self.pid,
+            'worker': self.worker,
+            'requests': [[route, code, histogram.counts, histogram.sum]
+                         for (route, code), histogram in self.requests.items()],
+            'connections_total': self.connections_total,
+            'gauges': self.gauges(),
+            'caches': self.server.cache_stats() if self.server is not None else {},
+        }
+
+    def path(self, worker):
+        return os.path.join(self.directory, f"{worker}.json")
+
+    def publish(self):
+        path = self.path(self.worker)
+        try:
+            with open(path + '.tmp', 'w') as f:
+                json.dump(self.snapshot(), f)
+            os.replace(path + '.tmp', path)
+        except OSError as e:
+            logging.warning(f"Can't write metrics snapshot: {e}")
+
+    def unpublish(self):
+        if self.directory is not None:
+            try:
+                os.unlink(self.path(self.worker))
+            except OSError:
+                pass
+
+    def snapshots(self):
+        """This worker's live snapshot plus the latest from every other live worker."""
+        snapshots = [self.snapshot()]
+        if self.directory is None:
+            return snapshots
+        for name in os.listdir(self.directory):
+            if not name.endswith('.json'):
+                continue
+            worker = name[:-5]
+            if worker == self.worker:
+                continue
+            try:
+                os.kill(int(worker.partition('.')[0]), 0)
+                with open(os.path.join(self.directory, name)) as f:
+                    snapshots.append(json.load(f))
+            except (OSError, ValueError):
+                continue
+        return snapshots
+
+    def render(self):
+        """All workers' metrics in the Prometheus text exposition format.
+
+        Counters and histograms are summed over the workers; gauges are
+        reported per worker.
+        """
+        snapshots = self.snapshots()
+        requests = {}
+        connections_total = 0
+        for snapshot in snapshots:
+            connections_total += snapshot['connections_total']
+            for route, code, counts, total in snapshot['requests']:
+                histogram = requests.setdefault((route, code), Histogram())
+                histogram.merge(Histogram(counts, total))
+        lines = [
+            "# HELP http_request_duration_seconds Time from request head to response written.",
+            "# TYPE http_request_duration_seconds histogram",
+        ]
+        for (route, code), histogram in sorted(requests.items()):
+            labels = f'route="{route}",code="{code}"'
+            cumulative = 0
+            for bound, count in zip(BUCKETS + ('+Inf',), histogram.counts):
+                cumulative += count
+                lines.append(f'http_request_duration_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f'http_request_duration_seconds_sum{{{labels}}} {histogram.sum}')
+            lines.append(f'http_request_duration_seconds_count{{{labels}}} {cumulative}')
+        lines.append("# HELP http_connections_total Connections accepted.")
+        lines.append("# TYPE http_connections_total counter")
+        lines.append(f"http_connections_total {connections_total}")
+        snapshots.sort(key=lambda snapshot: (snapshot['pid'], snapshot['worker']))
+        for name, help_text in GAUGES:
+            metric = 'http_server_' + name
+            lines.append(f"# HELP {metric} {help_text}")
+            lines.append(f"# TYPE {metric} gauge")
+            for snapshot in snapshots:
+                lines.append(f'{metric}{{worker="{snapshot["worker"]}"}} {snapshot["gauges"][name]}')
+        lines.extend(self.render_caches(snapshots))
+        return "\n".join(lines) + "\n"
+
+    def render_caches(self, snapshots):
+        """Counters and size gauges of the path, file and compressed caches."""
+        lines = []
+        for name, help_text in CACHE_COUNTERS:
+            metric = f'http_cache_{name}_total'
+            lines.append(f"# HELP {metric} {help_text}")
+            lines.append(f"# TYPE {metric} counter")
+            totals = {}
+            for snapshot in snapshots:
+                for cache, stats in snapshot.get('caches', {}).items():
+                    totals[cache] = totals.get(cache, 0) + stats.get(name, 0)
+            for cache, total in sorted(totals.items()):
+                lines.append(f'{metric}{{cache="{cache}"}} {total}')
+        for name, help_text in CACHE_GAUGES:
+            metric = f'http_cache_{name}'
+            lines.append(f"# HELP {metric} {help_text}")
+            lines.append(f"# TYPE {metric} gauge")
+            for snapshot in snapshots:
+                for cache, stats in sorted(snapshot.get('caches', {}).items()):
+                    if name in stats:
+                        lines.append(f'{metric}{{cache="{cache}",worker="{snapshot["worker"]}"}} {stats[name]}')
+        return lines
@@ -0,0 +1,194 @@
+import collections
+import logging
+import mimetypes
+import os
+import stat
+from urllib.parse import unquote
+
+from compression import SIDECAR_SUFFIXES
+
+
+def url_normalize(path):
+    """Normalize the path of a request target in a single pass.
+
+    The query is dropped, percent-escapes are decoded and ``.`` and ``..``
+    segments are resolved, with ``..`` never climbing above the root.  A
+    trailing slash is kept since it means the target is a directory.
+    Returns None if the path can't name a file at all.
+    """
+    path = unquote(path.partition('?')[0])
+    if '\0' in path:
+        return None
+    segments = []
+    for segment in path.split('/'):
+        if segment == '..':
+            if segments:
+                segments.pop()
+        elif segment and segment != '.':
+            segments.append(segment)
+    normalized = '/' + '/'.join(segments)
+    if segments and path.rsplit('/', 1)[-1] in ('', '.', '..'):
+        normalized += '/'
+    return normalized
+
+
+class Resolved(object):
+    """What a normalized path names under the document root.
+
+    ``kind`` is ``file``, ``forbidden`` (a directory without an index
+    file, or a link out of the root) or ``missing``.  For files ``path``
+    is the file to send, which is the index file for directories, and
+    ``sidecars`` maps content-codings to the ``(path, stat result)`` of
+    precompressed versions found next to it.
+    """
+
+    def __init__(self, kind, path=None, stat=None, file_type=None, sidecars=None):
+        self.kind = kind
+        self.path = path
+        self.stat = stat
+        self.file_type = file_type
+        self.sidecars = sidecars if sidecars is not None else {}
+
+
+MISSING = Resolved('missing')
+
+
+def same_file(a, b):
+    return a.st_ino == b.st_ino and a.st_size == b.st_size and a.st_mtime_ns == b.st_mtime_ns
+
+
+class PathResolver(object):
+    """Resolves request paths to files under ``root``.
+
+    Everything a lookup finds out is kept in an LRU of up to
+    ``max_entries`` paths, so a request for a known path doesn't touch
+    the filesystem.  Instead the cached paths are re-checked every
+    ``check_interval`` seconds in a pool thread and the ones that changed
+    are dropped.  Missing paths aren't cached, as anybody can make up
+    any number of them.
+
+    Files are looked up together with their precompressed sidecars,
+    named by ``sidecar_suffixes``, which are re-checked along with them.
+    """
+
+    def __init__(self, root='.', index='index.html', max_entries=4096, check_interval=1.0,
+                 sidecar_suffixes=SIDECAR_SUFFIXES):
+        self.root = os.path.realpath(root)
+        self.prefix = self.root.rstrip(os.sep) + os.sep
+        self.index = index
+        self.sidecar_suffixes = sidecar_suffixes
+        self.max_entries = max_entries
+        self.check_interval = check_interval
+        self.entries = collections.OrderedDict()
+        self.loop = None
+        self.handle = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def start(self, loop):
+        if self.max_entries:
+            self.loop = loop
+            self.handle = loop.call_later(self.check_interval, self.refresh)
+
+    def stop(self):
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+
+    def resolve(self, key):
+        """Resolve ``key``, a path returned by ``url_normalize``."""
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry
+        self.misses += 1
+        entry = self.lookup(key)
+        if entry is not MISSING and self.max_entries:
+            self.entries[key] = entry
+            if len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+        return entry
+
+    def lookup(self, key):
+        path = os.path.join(self.root, key.lstrip('/'))
+        try:
+            st = os.stat(path)
+        except OSError:
+            return MISSING
+        if stat.S_ISDIR(st.st_mode):
+            path = os.path.join(path, self.index)
+            try:
+                st = os.stat(path)
+            except OSError:
+                st = None
+            if st is None or not stat.S_ISREG(st.st_mode):
+                return Resolved('forbidden', path)
+        elif key.endswith('/') or not stat.S_ISREG(st.st_mode):
+            return MISSING
+        # The path is made of plain segments, so only a symlink can lead
+        # out of the root.
+        real = os.path.realpath(path)
+        if not real.startswith(self.prefix):
+            logging.warning(f"{key} leads out of the document root")
+            return Resolved('forbidden', path)
+        file_type, _ = mimetypes.guess_type(path)
+        return Resolved('file', path, st, file_type, self.find_sidecars(path))
+
+    def find_sidecars(self, path):
+        """Precompressed versions of the file ``path`` by content-coding."""
+        sidecars = {}
+        for encoding, suffix in self.sidecar_suffixes.items():
+            try:
+                st = os.stat(path + suffix)
+            except OSError:
+                continue
+            if stat.S_ISREG(st.st_mode) and os.path.realpath(path + suffix).startswith(self.prefix):
+                sidecars[encoding] = (path + suffix, st)
+        return sidecars
+
+    def sidecars_changed(self, entry):
+        found = self.find_sidecars(entry.path)
+        if found.keys() != entry.sidecars.keys():
+            return True
+        return not all(same_file(found[encoding][1], entry.sidecars[encoding][1]) for encoding in found)
+
+    def refresh(self):
+        self.handle = None
+        if not self.entries:
+            self.handle = self.loop.call_later(self.check_interval, self.refresh)
+            return
+        snapshot = list(self.entries.items())
+        future = self.loop.run_in_executor(None, self.changed, snapshot)
+        future.add_done_callback(lambda future: self.refreshed(future, snapshot))
+
+    def changed(self, snapshot):
+        """Keys in ``snapshot`` whose entries no longer hold; runs in a thread."""
+        stale = []
+        for key, entry in snapshot:
+            try:
+                st = os.stat(entry.path)
+            except OSError:
+                st = None
+            if entry.kind == 'file':
+                if st is None or not same_file(st, entry.stat) or self.sidecars_changed(entry):
+                    stale.append(key)
+            elif st is not None:
+                # The forbidden path turned into something else.
+                stale.append(key)
+        return stale
+
+    def refreshed(self, future, snapshot):
+        if self.loop is None or self.loop.is_closed():
+            return
+        if not future.cancelled() and future.exception() is None:
+            entries = dict(snapshot)
+            for key in future.result():
+                if self.entries.get(key) is entries[key]:
+                    del self.entries[key]
+        self.handle = self.loop.call_later(self.check_interval, self.refresh)
+
+    def stats(self):
+        return {'entries': len(self.entries), 'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
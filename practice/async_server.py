@@ -15,16 +15,21 @@ async def client_handler(reader: StreamReader, writer: StreamWriter) -> None:
     writer.close()
 
 
-loop = asyncio.get_event_loop()
-coro = asyncio.start_server(client_handler, '127.0.0.1', 9090, loop=loop)
-server = loop.run_until_complete(coro)
-
-print('Serving on {}'.format(server.sockets[0].getsockname()))
-try:
-    loop.run_forever()
-except KeyboardInterrupt:
-    pass
-
-server.close()
-loop.run_until_complete(server.wait_closed())
-loop.close()
\ No newline at end of file
+def main(host: str = '127.0.0.1', port: int = 9090) -> None:
+    loop = asyncio.new_event_loop()
+    coro = asyncio.start_server(client_handler, host, port)
+    server = loop.run_until_complete(coro)
+
+    print('Serving on {}'.format(server.sockets[0].getsockname()))
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+
+    server.close()
+    loop.run_until_complete(server.wait_closed())
+    loop.close()
+
+
+if __name__ == "__main__":
+    main()
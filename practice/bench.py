@@ -0,0 +1,307 @@
+"""Load generator and benchmark suite for the servers in this repository.
+
+Starts each target server on an ephemeral port, drives it with
+``--concurrency`` asyncio clients for ``--duration`` seconds and prints
+requests/sec and latency percentiles as JSON::
+
+    python practice/bench.py --targets http,wsgi --concurrency 50 --duration 10
+
+``--idle N`` first opens N keep-alive connections that make one request
+each and then sit idle for the whole run, to measure the server while it
+holds many quiet connections::
+
+    python practice/bench.py --targets http --idle 10000 --duration 60
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import resource
+import socket
+import subprocess
+import sys
+import time
+from typing import Dict, List, Optional, Tuple
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PRACTICE = os.path.join(ROOT, 'practice')
+
+TARGETS = {
+    'http': (ROOT, ['http_server.py', '-w', '{workers}', '--port', '{port}', '--log', 'warning',
+                    '--keepalive-timeout', '{keepalive_timeout}', '--max-connections', '{max_connections}']),
+    'wsgi': (ROOT, ['wsgi_server.py', 'my_app:application', '--port', '{port}', '--log', 'warning',
+                    '--max-connections', '{max_connections}']),
+    'practice-single': (PRACTICE, ['-c', 'import web_singlethread; web_singlethread.main(port={port})']),
+    'practice-multi': (PRACTICE, ['-c', 'import web_multithread; web_multithread.main(port={port})']),
+    'practice-async': (PRACTICE, ['-c', 'import async_server; async_server.main(port={port})']),
+}
+
+# Idle connections being opened at once; more overflows the listen backlog.
+IDLE_OPENING = 200
+
+BOUNDARY = b'benchboundary'
+POST_BODY = (b'--' + BOUNDARY + b'\r\n'
+             b'Content-Disposition: form-data; name="file"; filename="data.txt"\r\n'
+             b'Content-Type: text/plain\r\n\r\n' + b'x' * 1024 + b'\r\n'
+             b'--' + BOUNDARY + b'--\r\n')
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def static_paths() -> List[str]:
+    directory = os.path.join(ROOT, 'dir1')
+    return ['/dir1/' + name.replace(' ', '%20') for name in sorted(os.listdir(directory))
+            if not name.startswith('.') and os.path.isfile(os.path.join(directory, name))]
+
+
+def parse_mix(spec: str) -> List[Tuple[str, int]]:
+    """``get=8,404=1,post=1`` -> [('get', 8), ('404', 1), ('post', 1)]"""
+    mix = []
+    for item in spec.split(','):
+        kind, _, weight = item.partition('=')
+        if kind not in ('get', '404', 'post'):
+            raise ValueError(f"Unknown request kind {kind!r}")
+        mix.append((kind, int(weight or 1)))
+    return mix
+
+
+def build_request(kind: str, paths: List[str], keep_alive: bool) -> bytes:
+    connection = b'keep-alive' if keep_alive else b'close'
+    if kind == 'post':
+        return (b'POST / HTTP/1.1\r\nHost: localhost\r\nConnection: ' + connection +
+                b'\r\nContent-Type: multipart/form-data; boundary=' + BOUNDARY +
+                b'\r\nContent-Length: %d\r\n\r\n' % len(POST_BODY) + POST_BODY)
+    path = random.choice(paths) if kind == 'get' else f'/missing/{random.randrange(1 << 30)}'
+    return (b'GET ' + path.encode() + b' HTTP/1.1\r\nHost: localhost\r\nConnection: ' +
+            connection + b'\r\n\r\n')
+
+
+async def read_response(reader: asyncio.StreamReader) -> Tuple[int, bool]:
+    """Read one response; returns its status and whether the connection can be reused."""
+    head = await reader.readuntil(b'\r\n\r\n')
+    lines = head.decode('latin-1').split('\r\n')
+    version, status = lines[0].split(' ', 2)[:2]
+    headers = {}
+    for line in lines[1:]:
+        name, _, value = line.partition(':')
+        headers[name.strip().lower()] = value.strip().lower()
+    reusable = version == 'HTTP/1.1' and headers.get('connection') != 'close'
+    if 'content-length' in headers:
+        await reader.readexactly(int(headers['content-length']))
+    elif headers.get('transfer-encoding') == 'chunked':
+        while True:
+            size = int((await reader.readline()).split(b';')[0], 16)
+            await reader.readexactly(size + 2)
+            if not size:
+                break
+    else:
+        await reader.read()
+        reusable = False
+    return int(status), reusable
+
+
+class Stats(object):
+
+    def __init__(self) -> None:
+        self.latencies: List[float] = []
+        self.statuses: Dict[int, int] = {}
+        self.errors = 0
+
+    def report(self, elapsed: float) -> dict:
+        latencies = sorted(self.latencies)
+
+        def percentile(p: float) -> Optional[float]:
+            if not latencies:
+                return None
+            # Nearest-rank percentile.
+            rank = max(1, math.ceil(p / 100 * len(latencies)))
+            return round(latencies[rank - 1] * 1000, 3)
+
+        return {
+            'requests': len(latencies),
+            'errors': self.errors,
+            'duration': round(elapsed, 3),
+            'rps': round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+            'latency_ms': {
+                'p50': percentile(50),
+                'p99': percentile(99),
+                'p99.9': percentile(99.9),
+                'max': percentile(100),
+            },
+            'status': {str(code): count for code, count in sorted(self.statuses.items())},
+        }
+
+
+async def client(port: int, deadline: float, mix: List[Tuple[str, int]], paths: List[str],
+                 keep_alive: bool, stats: Stats) -> None:
+    kinds = [kind for kind, _ in mix]
+    weights = [weight for _, weight in mix]
+    reader = writer = None
+    reused = False
+    while time.monotonic() < deadline:
+        request = build_request(random.choices(kinds, weights)[0], paths, keep_alive)
+        start = time.perf_counter()
+        try:
+            if writer is None:
+                reader, writer = await asyncio.open_connection('127.0.0.1', port)
+                reused = False
+            writer.write(request)
+            status, reusable = await read_response(reader)
+        except (OSError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ValueError):
+            # A server may close an idle keep-alive connection without
+            # saying so; only failures on fresh connections are errors.
+            if not reused:
+                stats.errors += 1
+            reusable = False
+        else:
+            reused = True
+            stats.latencies.append(time.perf_counter() - start)
+            stats.statuses[status] = stats.statuses.get(status, 0) + 1
+        if not reusable and writer is not None:
+            writer.close()
+            reader = writer = None
+    if writer is not None:
+        writer.close()
+
+
+async def open_idle(port: int, paths: List[str], opening: asyncio.Semaphore
+                    ) -> Optional[Tuple[asyncio.StreamReader, asyncio.StreamWriter]]:
+    """Open a connection and make one keep-alive request on it; None if that fails."""
+    async with opening:
+        writer = None
+        try:
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.write(build_request('get', paths, True))
+            _, reusable = await read_response(reader)
+        except (OSError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ValueError):
+            reusable = False
+        if reusable:
+            return reader, writer
+        if writer is not None:
+            writer.close()
+        return None
+
+
+async def hold_idle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, deadline: float) -> bool:
+    """Leave a connection idle until ``deadline``; returns whether the server closed it first."""
+    try:
+        await asyncio.wait_for(reader.read(1), max(0.0, deadline - time.monotonic()))
+    except asyncio.TimeoutError:
+        dropped = False
+    except OSError:
+        dropped = True
+    else:
+        dropped = True
+    writer.close()
+    return dropped
+
+
+async def run_load(port: int, args: argparse.Namespace) -> dict:
+    stats = Stats()
+    mix = parse_mix(args.mix)
+    paths = static_paths()
+    opening = asyncio.Semaphore(IDLE_OPENING)
+    idle = await asyncio.gather(*(open_idle(port, paths, opening) for _ in range(args.idle)))
+    idle = [connection for connection in idle if connection is not None]
+    start = time.monotonic()
+    deadline = start + args.duration
+    held = asyncio.gather(*(hold_idle(reader, writer, deadline) for reader, writer in idle))
+    await asyncio.gather(*(client(port, deadline, mix, paths, args.keep_alive, stats)
+                           for _ in range(args.concurrency)))
+    report = stats.report(time.monotonic() - start)
+    if args.idle:
+        report['idle'] = {
+            'opened': len(idle),
+            'failed': args.idle - len(idle),
+            'dropped': sum(await held),
+        }
+    else:
+        await held
+    return report
+
+
+def wait_for_port(port: int, timeout: float = 10.0) -> None:
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.05)
+
+
+def benchmark(name: str, args: argparse.Namespace) -> dict:
+    cwd, argv = TARGETS[name]
+    port = free_port()
+    # Idle connections have to outlive the run, and fit besides the load.
+    keepalive_timeout = args.duration + 30 if args.idle else 5.0
+    max_connections = 10000 + args.idle
+    argv = [part.format(port=port, workers=args.workers, keepalive_timeout=keepalive_timeout,
+                        max_connections=max_connections) for part in argv]
+    process = subprocess.Popen([sys.executable] + argv, cwd=cwd,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                               start_new_session=True)
+    try:
+        wait_for_port(port)
+        result = asyncio.run(run_load(port, args))
+    finally:
+        os.killpg(process.pid, 2)
+        try:
+            process.wait(5)
+        except subprocess.TimeoutExpired:
+            os.killpg(process.pid, 9)
+            process.wait()
+    return result
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser("HTTP benchmark")
+    parser.add_argument("--targets", default="http,wsgi",
+                        help=f"comma-separated, from {', '.join(TARGETS)}")
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds per target")
+    parser.add_argument("--no-keep-alive", dest="keep_alive", action="store_false")
+    parser.add_argument("--mix", default="get=8,404=1,post=1",
+                        help="request kinds with weights: get (files from dir1/), 404, post")
+    parser.add_argument("--workers", type=int, default=1, help="-w for http_server.py")
+    parser.add_argument("--idle", type=int, default=0,
+                        help="keep-alive connections held open and idle during the run; only the "
+                             "http target's keep-alive timeout is lifted to outlast it")
+    parser.add_argument("--output", default=None, help="write the JSON report here as well")
+    return parser.parse_args()
+
+
+def main() -> None:
+    args = parse_args()
+    if args.idle:
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft < hard:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    report = {
+        'config': {
+            'concurrency': args.concurrency,
+            'duration': args.duration,
+            'keep_alive': args.keep_alive,
+            'mix': args.mix,
+            'workers': args.workers,
+            'idle': args.idle,
+        },
+        'results': {name: benchmark(name, args) for name in args.targets.split(',')},
+    }
+    output = json.dumps(report, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,176 @@
+import logging
+import os
+import select
+import signal
+import time
+
+
+class Worker(object):
+    """Bookkeeping for one forked worker process."""
+
+    def __init__(self, pid, generation):
+        self.pid = pid
+        self.generation = generation
+        self.started = time.monotonic()
+        self.retiring = None
+        self.killed = False
+
+
+class Master(object):
+    """Pre-fork supervisor.
+
+    Forks ``nworkers`` children (one per CPU by default) that each call
+    ``target(sock)``.  ``sock`` is a listening socket bound once here and
+    inherited by every worker, or None when workers bind their own
+    ``SO_REUSEPORT`` sockets and the kernel balances between them.
+
+    Workers that die are started again.  SIGHUP replaces the workers one at
+    a time: a new worker is started first, then the old one gets SIGTERM
+    and is given ``graceful_timeout`` seconds to finish in-flight requests.
+    SIGTERM stops every worker that way; SIGINT and SIGQUIT stop them at
+    once.
+    """
+
+    def __init__(self, target, sock=None, nworkers=None, graceful_timeout=30.0):
+        self.target = target
+        self.socket = sock
+        self.nworkers = nworkers or os.cpu_count() or 1
+        self.graceful_timeout = graceful_timeout
+        self.workers = {}
+        self.generation = 0
+        self.signals = []
+        self.stopping = False
+        self.respawn_at = 0.0
+        self.wakeup = None
+
+    def run(self):
+        self.install_signals()
+        logging.info(f"Master {os.getpid()} starting {self.nworkers} workers")
+        try:
+            while not (self.stopping and not self.workers):
+                self.maintain()
+                self.sleep(1.0)
+                self.handle_signals()
+                self.reap()
+                self.kill_stragglers()
+        finally:
+            if self.socket is not None:
+                self.socket.close()
+        logging.info("Master exiting")
+
+    def install_signals(self):
+        self.wakeup = os.pipe()
+        for fd in self.wakeup:
+            os.set_blocking(fd, False)
+        signal.set_wakeup_fd(self.wakeup[1], warn_on_full_buffer=False)
+        for signum in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT, signal.SIGQUIT, signal.SIGCHLD):
+            signal.signal(signum, self.signal_received)
+
+    def restore_signals(self):
+        for signum in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT, signal.SIGQUIT, signal.SIGCHLD):
+            signal.signal(signum, signal.SIG_DFL)
+        signal.set_wakeup_fd(-1)
+        for fd in self.wakeup:
+            os.close(fd)
+
+    def signal_received(self, signum, frame):
+        self.signals.append(signum)
+
+    def sleep(self, timeout):
+        """Wait until a signal arrives or ``timeout`` passes."""
+        ready, _, _ = select.select([self.wakeup[0]], [], [], timeout)
+        if ready:
+            try:
+                while os.read(self.wakeup[0], 4096):
+                    pass
+            except BlockingIOError:
+                pass
+
+    def handle_signals(self):
+        while self.signals:
+            signum = self.signals.pop(0)
+            if signum == signal.SIGHUP:
+                if not self.stopping:
+                    logging.info("Reloading workers")
+                    self.generation += 1
+            elif signum == signal.SIGTERM:
+                logging.info("Graceful shutdown")
+                self.stop(signal.SIGTERM)
+            elif signum in (signal.SIGINT, signal.SIGQUIT):
+                logging.info("Shutting down")
+                self.stop(signal.SIGINT)
+
+    def stop(self, signum):
+        self.stopping = True
+        for worker in list(self.workers.values()):
+            self.kill(worker, signum)
+
+    def kill(self, worker, signum):
+        if worker.retiring is None:
+            worker.retiring = time.monotonic()
+        try:
+            os.kill(worker.pid, signum)
+        except ProcessLookupError:
+            pass
+
+    def maintain(self):
+        """Start missing workers and retire one outdated worker at a time."""
+        if self.stopping:
+            return
+        active = [worker for worker in self.workers.values() if worker.retiring is None]
+        if len(active) < self.nworkers and time.monotonic() >= self.respawn_at:
+            for _ in range(self.nworkers - len(active)):
+                self.spawn()
+        draining = any(worker.retiring is not None for worker in self.workers.values())
+        outdated = [worker for worker in active if worker.generation != self.generation]
+        if outdated and not draining:
+            self.spawn()
+            self.kill(outdated[0], signal.SIGTERM)
+
+    def spawn(self):
+        pid = os.fork()
+        if pid:
+            self.workers[pid] = Worker(pid, self.generation)
+            logging.debug(f"Started worker {pid}")
+            return
+        code = 1
+        try:
+            self.restore_signals()
+            self.target(self.socket)
+            code = 0
+        except Exception:
+            logging.exception("Worker failed")
+        finally:
+            logging.shutdown()
+            os._exit(code)
+
+    def reap(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if not pid:
+                return
+            worker = self.workers.pop(pid, None)
+            if worker is None:
+                continue
+            code = os.waitstatus_to_exitcode(status)
+            if worker.retiring is not None:
+                logging.debug(f"Worker {pid} exited")
+                continue
+            logging.warning(f"Worker {pid} died with exit code {code}, restarting")
+            if time.monotonic() - worker.started < 1.0:
+                # Crashing on startup; don't fork in a tight loop.
+                self.respawn_at = time.monotonic() + 1.0
+
+    def kill_stragglers(self):
+        now = time.monotonic()
+        for worker in list(self.workers.values()):
+            if worker.retiring is not None and not worker.killed and now - worker.retiring > self.graceful_timeout:
+                logging.warning(f"Worker {worker.pid} didn't stop in time, killing it")
+                worker.killed = True
+                try:
+                    os.kill(worker.pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
@@ -0,0 +1,257 @@
+import re
+import tempfile
+from email.message import Message
+
+from http_parser import HTTPParseError, Headers
+
+
+HEX = re.compile(rb"[0-9A-Fa-f]+")
+
+
+def header_params(value):
+    """Parse a header value with ``; key=value`` parameters into a Message."""
+    message = Message()
+    message['content-type'] = value
+    return message
+
+
+class ChunkedDecoder(object):
+    """Incremental decoder for ``Transfer-Encoding: chunked`` bodies."""
+
+    SIZE, DATA, DATA_END, TRAILER = range(4)
+
+    def __init__(self, max_line=4096):
+        self.max_line = max_line
+        self.state = self.SIZE
+        self.remaining = 0
+        self.done = False
+
+    def feed(self, buffer):
+        """Decode as much of ``buffer`` as possible.
+
+        Returns ``(data, consumed)``; the caller drops ``consumed`` bytes
+        from the front of its buffer.  ``done`` is set once the last chunk
+        and the trailer have been read.
+        """
+        pos = 0
+        out = []
+        while not self.done:
+            if self.state == self.SIZE:
+                end = buffer.find(b"\r\n", pos)
+                if end == -1:
+                    if len(buffer) - pos > self.max_line:
+                        raise HTTPParseError(400, "Chunk size line too long")
+                    break
+                size = bytes(buffer[pos:end]).split(b";", 1)[0].strip()
+                if not HEX.fullmatch(size):
+                    raise HTTPParseError(400, "Invalid chunk size")
+                pos = end + 2
+                self.remaining = int(size, 16)
+                self.state = self.DATA if self.remaining else self.TRAILER
+            elif self.state == self.DATA:
+                take = min(self.remaining, len(buffer) - pos)
+                if not take:
+                    break
+                out.append(bytes(buffer[pos:pos + take]))
+                pos += take
+                self.remaining -= take
+                if not self.remaining:
+                    self.state = self.DATA_END
+            elif self.state == self.DATA_END:
+                if len(buffer) - pos < 2:
+                    break
+                if buffer[pos:pos + 2] != b"\r\n":
+                    raise HTTPParseError(400, "Missing CRLF after chunk")
+                pos += 2
+                self.state = self.SIZE
+            else:
+                end = buffer.find(b"\r\n", pos)
+                if end == -1:
+                    if len(buffer) - pos > self.max_line:
+                        raise HTTPParseError(400, "Trailer line too long")
+                    break
+                # Trailer fields are read and dropped.
+                self.done = end == pos
+                pos = end + 2
+        return b"".join(out), pos
+
+
+class Part(object):
+    """One multipart/form-data part, its data spooled to a temporary file."""
+
+    def __init__(self, headers, spool_threshold):
+        self.headers = headers
+        disposition = header_params(headers.get('content-disposition', ''))
+        self.name = disposition.get_param('name')
+        self.filename = disposition.get_param('filename')
+        self.content_type = headers.get('content-type', 'text/plain')
+        self.file = tempfile.SpooledTemporaryFile(max_size=spool_threshold)
+        self.size = 0
+
+    def write(self, data):
+        self.file.write(data)
+        self.size += len(data)
+
+    def close(self):
+        self.file.close()
+
+
+class MultipartParser(object):
+    """Incremental multipart/form-data parser.
+
+    Data is fed as it arrives.  Part bodies are written out as soon as it
+    is certain they can't contain the next delimiter, so at most one
+    delimiter's worth of bytes is held back between calls.
+    """
+
+    PREAMBLE, HEADERS, BODY, DELIMITER, EPILOGUE = range(5)
+
+    def __init__(self, boundary, spool_threshold=262144, max_part_headers=16384):
+        # The body is treated as if it started with CRLF so the first
+        # delimiter looks like every other one.
+        self.buffer = bytearray(b"\r\n")
+        self.delimiter = b"\r\n--" + boundary.encode('latin-1')
+        self.spool_threshold = spool_threshold
+        self.max_part_headers = max_part_headers
+        self.state = self.PREAMBLE
+        self.parts = []
+
+    def feed(self, data):
+        self.buffer += data
+        while True:
+            if self.state in (self.PREAMBLE, self.BODY):
+                index = self.buffer.find(self.delimiter)
+                if index == -1:
+                    keep = len(self.delimiter) - 1
+                    if len(self.buffer) > keep:
+                        self.write(self.buffer[:-keep])
+                        del self.buffer[:-keep]
+                    return
+                self.write(self.buffer[:index])
+                del self.buffer[:index + len(self.delimiter)]
+                self.state = self.DELIMITER
+            elif self.state == self.DELIMITER:
+                if len(self.buffer) < 2:
+                    return
+                if self.buffer.startswith(b"--"):
+                    self.state = self.EPILOGUE
+                    self.buffer.clear()
+                    return
+                end = self.buffer.find(b"\r\n")
+                if end == -1:
+                    return
+                if self.buffer[:end].strip(b" \t"):
+                    raise HTTPParseError(400, "Malformed multipart delimiter")
+                del self.buffer[:end + 2]
+                self.state = self.HEADERS
+            elif self.state == self.HEADERS:
+                if self.buffer.startswith(b"\r\n"):
+                    lines, consumed = [], 2
+                else:
+                    end = self.buffer.find(b"\r\n\r\n")
+                    if end == -1:
+                        if len(self.buffer) > self.max_part_headers:
+                            raise HTTPParseError(400, "Multipart headers too large")
+                        return
+                    lines, consumed = bytes(self.buffer[:end]).split(b"\r\n"), end + 4
+                headers = Headers()
+                for line in lines:
+                    name, sep, value = line.partition(b":")
+                    if not sep:
+                        raise HTTPParseError(400, "Malformed multipart header")
+                    headers.add(name.strip().decode('latin-1'), value.strip().decode('latin-1'))
+                del self.buffer[:consumed]
+                self.parts.append(Part(headers, self.spool_threshold))
+                self.state = self.BODY
+            else:
+                self.buffer.clear()
+                return
+
+    def write(self, data):
+        if self.state == self.BODY and data:
+            self.parts[-1].write(data)
+
+    def close(self):
+        if self.state != self.EPILOGUE:
+            raise HTTPParseError(400, "Incomplete multipart body")
+        for part in self.parts:
+            part.file.seek(0)
+
+
+class EmptyInput(object):
+    """Read-only file that is always at its end."""
+
+    def read(self, size=-1):
+        return b""
+
+    def readline(self, size=-1):
+        return b""
+
+    def readlines(self, hint=-1):
+        return []
+
+    def __iter__(self):
+        return iter(())
+
+
+class EmptyBody(object):
+    """Body of a request without one.
+
+    Nothing about it changes, so every such request shares ``EMPTY_BODY``
+    instead of setting up a ``RequestBody``.
+    """
+
+    size = 0
+    file = EmptyInput()
+    multipart = None
+    parts = ()
+
+    def finish(self):
+        pass
+
+    def close(self):
+        pass
+
+
+EMPTY_BODY = EmptyBody()
+
+
+class RequestBody(object):
+    """Destination for a request body as it is received.
+
+    multipart/form-data bodies are split into ``parts`` on the fly; any
+    other body is kept whole in ``file``.  Either way data stays in memory
+    only up to ``spool_threshold`` bytes per file and then spills to disk.
+    """
+
+    def __init__(self, content_type=None, spool_threshold=262144):
+        self.size = 0
+        self.file = None
+        self.multipart = None
+        self.parts = []
+        params = header_params(content_type or 'application/octet-stream')
+        boundary = params.get_param('boundary')
+        if params.get_content_type() == 'multipart/form-data' and boundary:
+            self.multipart = MultipartParser(boundary, spool_threshold)
+            self.parts = self.multipart.parts
+        else:
+            self.file = tempfile.SpooledTemporaryFile(max_size=spool_threshold)
+
+    def write(self, data):
+        self.size += len(data)
+        if self.multipart is not None:
+            self.multipart.feed(data)
+        else:
+            self.file.write(data)
+
+    def finish(self):
+        if self.multipart is not None:
+            self.multipart.close()
+        else:
+            self.file.seek(0)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+        for part in self.parts:
+            part.close()
@@ -0,0 +1,76 @@
+from path_resolver import PathResolver
+
+
+class Mount(object):
+    """Requests under ``prefix`` go to the WSGI ``app``, or to the static
+    files ``resolver`` finds.
+
+    ``prefix`` has no trailing slash, so it is the ``SCRIPT_NAME`` of the
+    mounted application; the root mount's is empty.
+    """
+
+    def __init__(self, prefix, app=None, resolver=None):
+        self.prefix = prefix
+        self.app = app
+        self.resolver = resolver
+
+
+class Node(object):
+    __slots__ = ('mount', 'children')
+
+    def __init__(self):
+        self.mount = None
+        self.children = {}
+
+
+class Router(object):
+    """Mount table dispatching request paths by prefix.
+
+    Prefixes match whole path segments, so ``/api`` takes ``/api`` and
+    ``/api/quote`` but not ``/apis``, and the longest mounted prefix wins.
+    Mounts are kept as a trie of segments: a lookup costs one dict probe
+    per segment of the path, however many mounts there are.
+    """
+
+    def __init__(self):
+        self.root = Node()
+        self.mounts = []
+
+    def mount(self, prefix, app=None, directory=None, **resolver_options):
+        """Mount the WSGI ``app``, or the static files under ``directory``, at ``prefix``."""
+        if (app is None) == (directory is None):
+            raise ValueError("Mount either an application or a directory")
+        segments = [segment for segment in prefix.split('/') if segment]
+        node = self.root
+        for segment in segments:
+            node = node.children.setdefault(segment, Node())
+        if node.mount is not None:
+            raise ValueError(f"{prefix} is mounted already")
+        resolver = PathResolver(directory, **resolver_options) if directory is not None else None
+        node.mount = Mount(''.join('/' + segment for segment in segments), app, resolver)
+        self.mounts.append(node.mount)
+        return node.mount
+
+    def match(self, path):
+        """The mount serving ``path`` and the rest of the path after its prefix.
+
+        The mount is None when nothing is mounted there.
+        """
+        node = self.root
+        found = node.mount, path
+        start = 0
+        length = len(path)
+        while node.children and start < length:
+            end = path.find('/', start + 1)
+            if end < 0:
+                end = length
+            node = node.children.get(path[start + 1:end])
+            if node is None:
+                break
+            if node.mount is not None:
+                found = node.mount, path[end:]
+            start = end
+        return found
+
+    def resolvers(self):
+        return [mount.resolver for mount in self.mounts if mount.resolver is not None]
@@ -0,0 +1,52 @@
+import logging
+import signal
+import threading
+
+
+class ServerThreads(object):
+    """Runs ``nthreads`` servers in one process, each in its own thread.
+
+    ``make_server(thread)`` builds the server for thread number
+    ``thread``.  Every server runs its own event loop with the usual
+    handlers, so however many connections come in, the pool stays at
+    ``nthreads`` threads; whichever loop accepts first takes a connection.
+
+    Signals only reach the main thread, which waits here: SIGTERM shuts
+    every server down gracefully, SIGINT stops them at once.
+    """
+
+    def __init__(self, make_server, nthreads):
+        self.make_server = make_server
+        self.nthreads = nthreads
+        self.servers = []
+        self.threads = []
+
+    def run(self):
+        self.servers = [self.make_server(thread) for thread in range(self.nthreads)]
+        previous = {signum: signal.signal(signum, self.signal_received) for signum in (signal.SIGTERM, signal.SIGINT)}
+        try:
+            for thread, server in enumerate(self.servers):
+                self.threads.append(threading.Thread(target=self.serve, args=(server,), name=f"server-{thread}"))
+                self.threads[-1].start()
+            for thread in self.threads:
+                thread.join()
+        finally:
+            for signum, handler in previous.items():
+                signal.signal(signum, handler)
+
+    def serve(self, server):
+        try:
+            server.serve_forever(install_signals=False)
+        except Exception:
+            logging.exception("Server thread failed")
+
+    def signal_received(self, signum, frame):
+        for server in self.servers:
+            loop = server.loop
+            if loop is None:
+                continue
+            try:
+                loop.call_soon_threadsafe(server.shutdown if signum == signal.SIGTERM else loop.stop)
+            except RuntimeError:
+                # The loop is closed already.
+                pass
@@ -1,6 +1,25 @@
 import requests
 import unittest
 import socket
+import http.client
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import tracemalloc
+
+import access_log
+import asgi_server
+import compression
+import file_cache
+import http_server
+import metrics
+import path_resolver
+import router
+import timer_wheel
+import wsgi_server
 
 
 class TestAsyncHTTPServer(unittest.TestCase):
@@ -136,7 +155,7 @@ class TestAsyncHTTPServer(unittest.TestCase):
 
     def test_filetype_css(self):
         """Content-Type for .css"""
-        r = requests.get(f'{self.host}:{self.port}/dir1/bootstrap.css')
+        r = requests.get(f'{self.host}:{self.port}/dir1/bootstrap.css', headers={'Accept-Encoding': 'identity'})
         data = r.content
         length = r.headers.get('Content-Length')
         ctype = r.headers.get('Content-Type')
@@ -147,7 +166,7 @@ class TestAsyncHTTPServer(unittest.TestCase):
 
     def test_filetype_js(self):
         """Content-Type for .js"""
-        r = requests.get(f'{self.host}:{self.port}/dir1/bootstrap.js')
+        r = requests.get(f'{self.host}:{self.port}/dir1/bootstrap.js', headers={'Accept-Encoding': 'identity'})
         data = r.content
         length = r.headers.get('Content-Length')
         ctype = r.headers.get('Content-Type')
@@ -200,11 +219,943 @@ class TestAsyncHTTPServer(unittest.TestCase):
         self.assertEqual(len(data), 123602)
         self.assertEqual(ctype, "image/gif")
 
+    def test_keep_alive(self):
+        """Connection kept alive for HTTP/1.1"""
+        with requests.Session() as session:
+            r1 = session.get(f'{self.host}:{self.port}/dir1/page.html')
+            r2 = session.get(f'{self.host}:{self.port}/dir1/text..txt')
+        self.assertEqual(r1.status_code, 200)
+        self.assertEqual(r2.status_code, 200)
+        self.assertEqual(r1.headers.get('Connection'), 'keep-alive')
+
+    def test_connection_close(self):
+        """Connection: close honoured"""
+        r = requests.get(f'{self.host}:{self.port}/dir1/page.html', headers={'Connection': 'close'})
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.headers.get('Connection'), 'close')
+
+    def test_pipelined_requests(self):
+        """Pipelined requests answered in order"""
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.connect(("localhost", self.port))
+        s.sendall(b"GET /dir1/page.html HTTP/1.1\r\nHost: localhost\r\n\r\n"
+                  b"GET /dir1/text..txt HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n\r\n")
+        data = b''
+        while True:
+            chunk = s.recv(4096)
+            if not chunk:
+                break
+            data += chunk
+        s.close()
+        self.assertEqual(data.count(b"HTTP/1.1 200 OK"), 2)
+        self.assertLess(data.index(b"Page sample"), data.index(b"hello"))
+
+    def test_pipelined_large_files(self):
+        """Large pipelined responses arrive complete"""
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+        s.connect(("localhost", self.port))
+        s.sendall(b"GET /dir1/cat.jpg HTTP/1.1\r\nHost: localhost\r\n\r\n" * 4 +
+                  b"GET /dir1/pokemon.gif HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n\r\n")
+        data = b''
+        while True:
+            chunk = s.recv(65536)
+            if not chunk:
+                break
+            data += chunk
+        s.close()
+        self.assertEqual(data.count(b"HTTP/1.1 200 OK"), 5)
+        self.assertEqual(data.count(b"Content-Length: 140391"), 4)
+        self.assertEqual(len(data) - data.rindex(b"\r\n\r\n") - 4, 123602)
+
+    def test_etag_not_modified(self):
+        """If-None-Match with current ETag returns 304"""
+        r = requests.get(f'{self.host}:{self.port}/dir1/page.html')
+        etag = r.headers.get('ETag')
+        self.assertIsNotNone(etag)
+        self.assertIsNotNone(r.headers.get('Last-Modified'))
+        r = requests.get(f'{self.host}:{self.port}/dir1/page.html', headers={'If-None-Match': etag})
+        self.assertEqual(r.status_code, 304)
+        self.assertEqual(len(r.content), 0)
+
+    def test_if_modified_since(self):
+        """If-Modified-Since honoured"""
+        r = requests.get(f'{self.host}:{self.port}/dir1/page.html')
+        last_modified = r.headers.get('Last-Modified')
+        r = requests.get(f'{self.host}:{self.port}/dir1/page.html', headers={'If-Modified-Since': last_modified})
+        self.assertEqual(r.status_code, 304)
+        r = requests.get(f'{self.host}:{self.port}/dir1/page.html',
+                         headers={'If-Modified-Since': 'Mon, 01 Jan 2001 00:00:00 GMT'})
+        self.assertEqual(r.status_code, 200)
+
+    def test_range_request(self):
+        """Single byte range returns 206"""
+        r = requests.get(f'{self.host}:{self.port}/dir1/cat.jpg', headers={'Range': 'bytes=100-199'})
+        self.assertEqual(r.status_code, 206)
+        self.assertEqual(r.headers.get('Content-Range'), 'bytes 100-199/140391')
+        self.assertEqual(int(r.headers.get('Content-Length')), 100)
+        self.assertEqual(len(r.content), 100)
+
+    def test_multiple_ranges(self):
+        """Several ranges returned as multipart/byteranges"""
+        r = requests.get(f'{self.host}:{self.port}/dir1/page.html', headers={'Range': 'bytes=0-5,-6'})
+        self.assertEqual(r.status_code, 206)
+        self.assertIn('multipart/byteranges', r.headers.get('Content-Type'))
+        self.assertIn(b'Content-Range: bytes 0-5/38', r.content)
+        self.assertIn(b'Content-Range: bytes 32-37/38', r.content)
+
+    def test_range_not_satisfiable(self):
+        """Range beyond end of file returns 416"""
+        r = requests.get(f'{self.host}:{self.port}/dir1/page.html', headers={'Range': 'bytes=1000-'})
+        self.assertEqual(r.status_code, 416)
+        self.assertEqual(r.headers.get('Content-Range'), 'bytes */38')
+
+    def test_gzip_encoding(self):
+        """Compressible file served gzip-encoded when accepted"""
+        # Compressed in the background; sent as is until then.
+        for _ in range(50):
+            r = requests.get(f'{self.host}:{self.port}/dir1/bootstrap.css', headers={'Accept-Encoding': 'gzip'})
+            self.assertEqual(r.status_code, 200)
+            if r.headers.get('Content-Encoding') is not None:
+                break
+            time.sleep(0.1)
+        self.assertEqual(r.headers.get('Content-Encoding'), 'gzip')
+        self.assertEqual(r.headers.get('Vary'), 'Accept-Encoding')
+        self.assertLess(int(r.headers.get('Content-Length')), 122849)
+        self.assertEqual(len(r.content), 122849)
+
+    def test_binary_not_encoded(self):
+        """Images are not compressed"""
+        r = requests.get(f'{self.host}:{self.port}/dir1/cat.jpg', headers={'Accept-Encoding': 'gzip'})
+        self.assertIsNone(r.headers.get('Content-Encoding'))
+        self.assertEqual(int(r.headers.get('Content-Length')), 140391)
+
+    def test_header_fields_too_large(self):
+        """Oversized header block returns 431"""
+        r = requests.get(f'{self.host}:{self.port}/dir1/page.html', headers={'X-Large': 'a' * 70000})
+        self.assertEqual(r.status_code, 431)
+
+    def test_malformed_request_line(self):
+        """Malformed request line returns 400"""
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.connect(("localhost", self.port))
+        s.sendall(b"GARBAGE\r\n\r\n")
+        data = s.recv(1024)
+        s.close()
+        self.assertTrue(data.startswith(b"HTTP/1.1 400"))
+
+    def test_header_case_insensitive(self):
+        """Header names are case-insensitive"""
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.connect(("localhost", self.port))
+        s.sendall(b"GET /dir1/page.html HTTP/1.1\r\nHOST: localhost\r\nCONNECTION: CLOSE\r\n\r\n")
+        data = b''
+        while True:
+            chunk = s.recv(4096)
+            if not chunk:
+                break
+            data += chunk
+        s.close()
+        self.assertIn(b"Connection: close", data)
+
+    def test_multipart_upload(self):
+        """First part of a multipart upload is echoed back"""
+        data = b"0123456789" * 50000
+        r = requests.post(f'{self.host}:{self.port}/',
+                          files={'file': ('data.bin', data, 'application/octet-stream'),
+                                 'other': ('other.txt', b'ignored', 'text/plain')})
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.headers.get('Content-Type'), 'application/octet-stream')
+        self.assertEqual(r.content, data)
+
+    def test_raw_body_upload(self):
+        """Non-multipart bodies are echoed back"""
+        r = requests.post(f'{self.host}:{self.port}/', data=b'{"a": 1}',
+                          headers={'Content-Type': 'application/json'})
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.content, b'{"a": 1}')
+
+    def test_chunked_upload(self):
+        """Chunked request bodies are decoded"""
+        r = requests.post(f'{self.host}:{self.port}/', data=iter([b'hello ', b'chunked ', b'world']),
+                          headers={'Content-Type': 'text/plain'})
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.content, b'hello chunked world')
+
+    def test_body_too_large(self):
+        """Bodies over the size limit are refused with 413"""
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.connect(("localhost", self.port))
+        s.sendall(b"POST / HTTP/1.1\r\nHost: localhost\r\nContent-Length: 100000000000\r\n\r\n")
+        data = s.recv(1024)
+        s.close()
+        self.assertTrue(data.startswith(b"HTTP/1.1 413"))
+
+
+class FakeTransport(object):
+    def set_write_buffer_limits(self, high=None):
+        pass
+
+    def get_extra_info(self, name):
+        return None
+
+
+class TestConnectionMemory(unittest.TestCase):
+
+    def test_idle_connection_budget(self):
+        """Idle connections stay within the memory budget"""
+        server = http_server.AsyncServer(port=0, handler_class=http_server.AsyncHTTPRequestHandler)
+        transports = [FakeTransport() for _ in range(1000)]
+        handlers = []
+        tracemalloc.start()
+        try:
+            start = tracemalloc.get_traced_memory()[0]
+            for transport in transports:
+                handler = server.protocol_factory()
+                handler.connection_made(transport)
+                handlers.append(handler)
+            per_connection = (tracemalloc.get_traced_memory()[0] - start) / len(handlers)
+        finally:
+            tracemalloc.stop()
+            server.socket.close()
+        self.assertLessEqual(per_connection, http_server.CONNECTION_MEMORY_BUDGET)
+
+    def test_large_buffers_not_joined(self):
+        """Small buffers are joined, large ones written as they are"""
+        server = http_server.AsyncServer(port=0, handler_class=http_server.AsyncHTTPRequestHandler)
+        self.addCleanup(server.socket.close)
+        handler = server.protocol_factory()
+        handler.transport = FakeTransport()
+        handler.transport.writes = []
+        handler.transport.write = handler.transport.writes.append
+        body = b'x' * http_server.JOIN_LIMIT
+        handler.write_buffers([b'head', b'ers', body, b'tail'])
+        self.assertEqual(handler.transport.writes, [b'headers', body, b'tail'])
+        self.assertIs(handler.transport.writes[1], body)
+
+
+class TestParseRange(unittest.TestCase):
+
+    def test_ranges(self):
+        """Ranges are clipped to the size, sorted and merged"""
+        parse = http_server.parse_range
+        self.assertEqual(parse('bytes=0-9', 100), [(0, 9)])
+        self.assertEqual(parse('bytes=90-', 100), [(90, 99)])
+        self.assertEqual(parse('bytes=-10', 100), [(90, 99)])
+        self.assertEqual(parse('bytes=50-200', 100), [(50, 99)])
+        self.assertEqual(parse('bytes=20-29, 0-9, 5-14', 100), [(0, 14), (20, 29)])
+
+    def test_unsatisfiable(self):
+        """Well-formed ranges past the end satisfy nothing"""
+        self.assertEqual(http_server.parse_range('bytes=100-', 100), [])
+        self.assertEqual(http_server.parse_range('bytes=-0, 200-300', 100), [])
+
+    def test_ignored(self):
+        """Malformed range sets are ignored"""
+        for header in ('bytes=', 'bytes=-0', 'bytes=,', 'bytes=-', 'bytes=5', 'bytes=9-5', 'bytes=a-b',
+                       'bytes=--5', 'bytes=+1-2', 'bytes=\u00b2-', 'items=0-9', 'bytes=' + ','.join(['0-0'] * 17)):
+            self.assertIsNone(http_server.parse_range(header, 100), header)
+
+
+class TestRouter(unittest.TestCase):
+
+    def setUp(self):
+        self.router = router.Router()
+        self.root = self.router.mount('/', app=object())
+        self.api = self.router.mount('/api/', app=object())
+        self.v2 = self.router.mount('/api/v2', app=object())
+        self.static = self.router.mount('/static', directory='dir1')
+
+    def test_longest_prefix(self):
+        """Longest mounted prefix wins"""
+        self.assertEqual(self.router.match('/api/v2/quote'), (self.v2, '/quote'))
+        self.assertEqual(self.router.match('/api/v1/quote'), (self.api, '/v1/quote'))
+        self.assertEqual(self.router.match('/static/page.html'), (self.static, '/page.html'))
+
+    def test_whole_segments(self):
+        """Prefixes match whole path segments"""
+        self.assertEqual(self.router.match('/apis'), (self.root, '/apis'))
+        self.assertEqual(self.router.match('/api'), (self.api, ''))
+        self.assertEqual(self.router.match('/api/'), (self.api, '/'))
+        self.assertEqual(self.api.prefix, '/api')
+
+    def test_unmounted(self):
+        """Paths outside every mount match nothing"""
+        mounts = router.Router()
+        mounts.mount('/api', app=object())
+        self.assertEqual(mounts.match('/other'), (None, '/other'))
+
+    def test_duplicate_mount(self):
+        """A prefix can be mounted once"""
+        with self.assertRaises(ValueError):
+            self.router.mount('/api', app=object())
+
+
+class TestCompressedCache(unittest.TestCase):
+
+    def test_entry_cap(self):
+        """Bodiless entries are capped by count"""
+        cache = compression.CompressedCache(max_entries=3)
+        for n in range(10):
+            cache.put((f'"etag-{n}"', 'gzip'), None)
+        self.assertEqual(len(cache.entries), 3)
+        self.assertEqual(cache.evictions, 7)
+        self.assertIn(('"etag-9"', 'gzip'), cache)
+        self.assertNotIn(('"etag-0"', 'gzip'), cache)
+
+
+class TestPathResolver(unittest.TestCase):
+
+    def setUp(self):
+        self.base = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.base)
+        self.root = os.path.join(self.base, 'root')
+        os.makedirs(os.path.join(self.root, 'sub'))
+        with open(os.path.join(self.root, 'sub', 'file.txt'), 'w') as f:
+            f.write('inside')
+        with open(os.path.join(self.base, 'secret.txt'), 'w') as f:
+            f.write('outside')
+        self.resolver = path_resolver.PathResolver(self.root)
+
+    def test_dot_segments(self):
+        """.. segments never climb above the root"""
+        normalize = path_resolver.url_normalize
+        self.assertEqual(normalize('/sub/../sub/file.txt'), '/sub/file.txt')
+        self.assertEqual(normalize('/../../secret.txt'), '/secret.txt')
+        self.assertEqual(normalize('/sub/%2e%2e/%2E%2E/secret.txt'), '/secret.txt')
+        self.assertEqual(normalize('/sub%2f..%2f..%2fsecret.txt'), '/secret.txt')
+        self.assertEqual(normalize('/sub/./file.txt?x=/../y'), '/sub/file.txt')
+
+    def test_trailing_dot(self):
+        """A trailing /. or /.. names a directory"""
+        self.assertEqual(path_resolver.url_normalize('/sub/.'), '/sub/')
+        self.assertEqual(path_resolver.url_normalize('/sub/x/..'), '/sub/')
+        self.assertEqual(path_resolver.url_normalize('/.'), '/')
+
+    def test_nul(self):
+        """Paths with NUL bytes name nothing"""
+        self.assertIsNone(path_resolver.url_normalize('/sub/file.txt%00.html'))
+        self.assertIsNone(path_resolver.url_normalize('/sub/\0'))
+
+    def test_anchored_at_root(self):
+        """Lookups are relative to the document root"""
+        entry = self.resolver.resolve(path_resolver.url_normalize('/sub/file.txt'))
+        self.assertEqual(entry.kind, 'file')
+        self.assertEqual(entry.path, os.path.join(self.root, 'sub', 'file.txt'))
+        escaped = self.resolver.resolve(path_resolver.url_normalize('/../secret.txt'))
+        self.assertEqual(escaped.kind, 'missing')
+
+    def test_symlink_out_of_root(self):
+        """Links leading out of the root are forbidden"""
+        os.symlink(os.path.join(self.base, 'secret.txt'), os.path.join(self.root, 'link.txt'))
+        os.symlink(self.base, os.path.join(self.root, 'up'))
+        self.assertEqual(self.resolver.resolve('/link.txt').kind, 'forbidden')
+        self.assertEqual(self.resolver.resolve('/up/secret.txt').kind, 'forbidden')
+
+    def test_symlink_inside_root(self):
+        """Links within the root are followed"""
+        os.symlink(os.path.join(self.root, 'sub', 'file.txt'), os.path.join(self.root, 'alias.txt'))
+        self.assertEqual(self.resolver.resolve('/alias.txt').kind, 'file')
+
+    def test_sidecars(self):
+        """Precompressed sidecars inside the root are found and re-checked"""
+        path = os.path.join(self.root, 'sub', 'file.txt')
+        with open(path + '.gz', 'wb') as f:
+            f.write(b'gzipped')
+        os.symlink(os.path.join(self.base, 'secret.txt'), path + '.br')
+        entry = self.resolver.resolve('/sub/file.txt')
+        self.assertEqual(list(entry.sidecars), ['gzip'])
+        self.assertEqual(entry.sidecars['gzip'][0], path + '.gz')
+        self.assertEqual(self.resolver.changed(list(self.resolver.entries.items())), [])
+        os.remove(path + '.gz')
+        self.assertEqual(self.resolver.changed(list(self.resolver.entries.items())), ['/sub/file.txt'])
+
+    def test_evictions(self):
+        """The oldest lookup is dropped past max_entries"""
+        resolver = path_resolver.PathResolver(self.root, max_entries=1)
+        resolver.resolve('/sub/file.txt')
+        resolver.resolve('/sub/')
+        self.assertEqual(resolver.stats(), {'entries': 1, 'hits': 0, 'misses': 2, 'evictions': 1})
+
+
+class TestAccessLog(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.path = os.path.join(directory, 'access.log')
+
+    def make_log(self, **options):
+        log = access_log.AccessLog(self.path, **options)
+        self.addCleanup(log.close)
+        return log
+
+    def lines(self):
+        if not os.path.exists(self.path):
+            return []
+        with open(self.path) as f:
+            return f.read().splitlines()
+
+    def wait_for_lines(self, count):
+        for _ in range(100):
+            if len(self.lines()) >= count:
+                break
+            time.sleep(0.01)
+        return self.lines()
+
+    def test_text_format(self):
+        """Text entries are the common log format plus the duration"""
+        log = self.make_log()
+        log.start()
+        log.log('127.0.0.1', 'GET', '/index.html', 'HTTP/1.1', 200, 34, 0.0015)
+        log.log(None, 'GET', '/', 'HTTP/1.0', 404, 0, 0.25)
+        log.close()
+        first, second = self.lines()
+        self.assertRegex(first, r'^127\.0\.0\.1 - - \[\d\d/\w{3}/\d{4}:\d\d:\d\d:\d\d \+0000\] '
+                                r'"GET /index\.html HTTP/1\.1" 200 34 0\.001500$')
+        self.assertTrue(second.startswith('- - - ['))
+        self.assertTrue(second.endswith('"GET / HTTP/1.0" 404 0 0.250000'))
+
+    def test_json_format(self):
+        """JSON entries are one object per line"""
+        log = self.make_log(log_format='json')
+        log.start()
+        log.log('127.0.0.1', 'POST', '/upload', 'HTTP/1.1', 201, 5, 0.1234567)
+        log.close()
+        entry, = map(json.loads, self.lines())
+        self.assertEqual(entry['status'], 201)
+        self.assertEqual(entry['path'], '/upload')
+        self.assertEqual(entry['bytes'], 5)
+        self.assertEqual(entry['duration'], 0.123457)
+
+    def test_batch_size(self):
+        """A full batch is written without waiting for the interval"""
+        log = self.make_log(batch_size=3, flush_interval=60)
+        log.start()
+        for n in range(4):
+            log.log('c', 'GET', f'/{n}', 'HTTP/1.1', 200, 0, 0.0)
+        self.assertEqual(len(self.wait_for_lines(3)), 3)
+        time.sleep(0.1)
+        self.assertEqual(len(self.lines()), 3)
+        log.close()
+        self.assertEqual(len(self.lines()), 4)
+
+    def test_flush_interval(self):
+        """A partial batch is written after the interval"""
+        log = self.make_log(batch_size=100, flush_interval=0.1)
+        log.start()
+        log.log('c', 'GET', '/', 'HTTP/1.1', 200, 0, 0.0)
+        self.assertEqual(len(self.wait_for_lines(1)), 1)
+
+    def test_dropped_when_full(self):
+        """Entries that don't fit in the queue are counted and dropped"""
+        log = self.make_log(max_queue=2)
+        for n in range(5):
+            log.log('c', 'GET', f'/{n}', 'HTTP/1.1', 200, 0, 0.0)
+        self.assertEqual(log.dropped, 3)
+        log.start()
+        log.close()
+        self.assertEqual([line.split('"')[1] for line in self.lines()], ['GET /0 HTTP/1.1', 'GET /1 HTTP/1.1'])
+
+    def test_shared(self):
+        """The writer runs from the first start to the last close"""
+        log = self.make_log(flush_interval=60)
+        log.start()
+        thread = log.thread
+        log.start()
+        self.assertIs(log.thread, thread)
+        log.close()
+        self.assertTrue(thread.is_alive())
+        log.log('c', 'GET', '/', 'HTTP/1.1', 200, 0, 0.0)
+        log.close()
+        self.assertIsNone(log.thread)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(len(self.lines()), 1)
+        log.close()
+
+
+class TestMetrics(unittest.TestCase):
+
+    def test_cache_metrics(self):
+        """Cache counters add up across workers, sizes are per worker"""
+        snapshots = [
+            {'worker': '1', 'caches': {'file': {'entries': 2, 'bytes': 10, 'hits': 3, 'misses': 1, 'evictions': 0}}},
+            {'worker': '2', 'caches': {'file': {'entries': 1, 'bytes': 4, 'hits': 2, 'misses': 5, 'evictions': 1}}},
+            {'worker': '3'},
+        ]
+        lines = metrics.Metrics().render_caches(snapshots)
+        self.assertIn('http_cache_hits_total{cache="file"} 5', lines)
+        self.assertIn('http_cache_misses_total{cache="file"} 6', lines)
+        self.assertIn('http_cache_evictions_total{cache="file"} 1', lines)
+        self.assertIn('http_cache_entries{cache="file",worker="1"} 2', lines)
+        self.assertIn('http_cache_bytes{cache="file",worker="2"} 4', lines)
+
+
+def start_server(test, server, app):
+    """Serve ``app`` from ``server`` in a thread until ``test`` ends; returns the port."""
+    if app is not None:
+        server.set_app(app)
+    thread = threading.Thread(target=server.serve_forever, kwargs={'install_signals': False}, daemon=True)
+    thread.start()
+    for _ in range(200):
+        if server.accepting:
+            break
+        time.sleep(0.01)
+
+    def stop():
+        loop = server.loop
+        if loop is not None and not loop.is_closed():
+            loop.call_soon_threadsafe(loop.stop)
+        thread.join(5)
+
+    test.addCleanup(stop)
+    return server.socket.getsockname()[1]
+
+
+def exchange(port, request):
+    """Send a raw ``request`` and read until the server closes the connection."""
+    s = socket.create_connection(("localhost", port))
+    s.settimeout(5)
+    s.sendall(request)
+    data = b''
+    while True:
+        chunk = s.recv(65536)
+        if not chunk:
+            break
+        data += chunk
+    s.close()
+    return data
+
+
+class FakeLoop(object):
+    def time(self):
+        return 0.0
+
+    def call_at(self, when, callback):
+        return None
+
+
+class TestTimerWheel(unittest.TestCase):
+
+    def setUp(self):
+        self.wheel = timer_wheel.TimerWheel(resolution=0.5, slots=4)
+        self.wheel.start(FakeLoop())
+        self.fired = []
+
+    def advance(self, ticks):
+        for _ in range(ticks):
+            self.wheel.advance()
+
+    def test_fires_when_due(self):
+        """A timer fires on the tick after its delay has passed"""
+        self.wheel.schedule(1.0, lambda: self.fired.append('timer'))
+        self.advance(2)
+        self.assertEqual(self.fired, [])
+        self.advance(1)
+        self.assertEqual(self.fired, ['timer'])
+        self.advance(8)
+        self.assertEqual(self.fired, ['timer'])
+
+    def test_cancel(self):
+        """Cancelled timers don't fire"""
+        timer = self.wheel.schedule(0.5, lambda: self.fired.append('timer'))
+        timer.cancel()
+        timer.cancel()
+        self.advance(4)
+        self.assertEqual(self.fired, [])
+
+    def test_beyond_one_turn(self):
+        """Timers further out than the wheel wait out the extra turns"""
+        self.wheel.schedule(4.0, lambda: self.fired.append('far'))
+        self.wheel.schedule(0.0, lambda: self.fired.append('near'))
+        self.advance(8)
+        self.assertEqual(self.fired, ['near'])
+        self.advance(1)
+        self.assertEqual(self.fired, ['near', 'far'])
+
+    def test_failing_callback(self):
+        """A callback that raises doesn't stop the others"""
+        self.wheel.schedule(0.5, lambda: 1 / 0)
+        self.wheel.schedule(0.5, lambda: self.fired.append('timer'))
+        self.advance(2)
+        self.assertEqual(self.fired, ['timer'])
+
+
+class TestHTTPServer(unittest.TestCase):
+
+    def serve(self, **options):
+        self.server = http_server.AsyncServer(port=0, handler_class=http_server.AsyncHTTPRequestHandler, **options)
+        # Fine enough for the short timeouts here.
+        self.server.timers = timer_wheel.TimerWheel(resolution=0.05)
+        return start_server(self, self.server, None)
+
+    def connect(self, port):
+        s = socket.create_connection(("localhost", port))
+        s.settimeout(5)
+        self.addCleanup(s.close)
+        return s
+
+    def wait_until(self, condition):
+        """Poll ``condition``, which is about state of the server thread."""
+        for _ in range(100):
+            if condition():
+                return True
+            time.sleep(0.02)
+        return False
+
+    def read_all(self, s):
+        data = b''
+        while True:
+            chunk = s.recv(65536)
+            if not chunk:
+                return data
+            data += chunk
+
+    def test_header_timeout(self):
+        """A head that trickles in too slowly gets a 408"""
+        port = self.serve(header_timeout=0.3)
+        s = self.connect(port)
+        start = time.monotonic()
+        for part in (b"GET / HTTP/1.1\r\n", b"Host: x\r\n", b"X-Slow: 1\r\n", b"X-Slow: 2\r\n"):
+            s.sendall(part)
+            time.sleep(0.1)
+        data = self.read_all(s)
+        self.assertTrue(data.startswith(b"HTTP/1.1 408 "), data)
+        self.assertLess(time.monotonic() - start, 2)
+
+    def test_body_timeout(self):
+        """A body that stops arriving gets a 408"""
+        port = self.serve(body_timeout=0.2)
+        s = self.connect(port)
+        s.sendall(b"POST / HTTP/1.1\r\nHost: x\r\nContent-Length: 10\r\n\r\nabc")
+        self.assertTrue(self.read_all(s).startswith(b"HTTP/1.1 408 "))
+
+    def test_idle_timeout(self):
+        """Idle keep-alive connections are closed without a response"""
+        port = self.serve(keepalive_timeout=0.2)
+        s = self.connect(port)
+        s.sendall(b"GET /index.html HTTP/1.1\r\nHost: x\r\n\r\n")
+        data = self.read_all(s)
+        self.assertTrue(data.startswith(b"HTTP/1.1 200 "))
+        self.assertEqual(data.count(b"HTTP/1.1 "), 1)
+
+    def test_write_stall(self):
+        """A client that stops reading is cut off after the write timeout"""
+        port = self.serve(write_timeout=0.2, write_buffer_limit=65536)
+        s = self.connect(port)
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 16384)
+        s.sendall(b"GET /dir1/cat.jpg HTTP/1.1\r\nHost: x\r\n\r\n" * 50)
+        self.assertTrue(self.wait_until(lambda: not self.server.connections))
+
+    def test_not_modified_without_opening(self):
+        """Conditional requests for uncached files are answered from the resolver's stat"""
+        port = self.serve()
+        connection = http.client.HTTPConnection("localhost", port, timeout=5)
+        self.addCleanup(connection.close)
+        connection.request('GET', '/dir1/page.html')
+        response = connection.getresponse()
+        response.read()
+        etag = response.getheader('ETag')
+
+        def refuse(*args, **kwargs):
+            raise AssertionError("Opened a file for a 304")
+        http_server.open = refuse
+        self.addCleanup(delattr, http_server, 'open')
+        connection.request('GET', '/dir1/page.html', headers={'If-None-Match': etag})
+        response = connection.getresponse()
+        response.read()
+        self.assertEqual(response.status, 304)
+
+    def test_transfer_codings(self):
+        """Chunked is the only transfer-coding accepted"""
+        port = self.serve()
+        body = b"3\r\nabc\r\n0\r\n\r\n"
+        for coding, status in ((b"chunked", b"200"), (b"Chunked ", b"200"), (b"gzip, chunked", b"501"),
+                               (b"chunked, chunked", b"501")):
+            data = exchange(port, b"POST / HTTP/1.1\r\nHost: x\r\nConnection: close\r\n"
+                                  b"Transfer-Encoding: " + coding + b"\r\n\r\n" + body)
+            self.assertTrue(data.startswith(b"HTTP/1.1 " + status), (coding, data[:40]))
+
+    def test_unread_pipeline(self):
+        """Pipelined requests wait while the client isn't reading"""
+        port = self.serve(file_cache=file_cache.FileCache(), write_buffer_limit=65536)
+        size = os.path.getsize('dir1/cat.jpg')
+        s = socket.create_connection(("localhost", port))
+        self.addCleanup(s.close)
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 16384)
+        s.sendall(b"GET /dir1/cat.jpg HTTP/1.1\r\nHost: x\r\n\r\n" * 50)
+        time.sleep(0.5)
+        connection, = self.server.connections
+        self.assertIsNotNone(connection.drain_waiter)
+        self.assertLess(connection.transport.get_write_buffer_size(), 65536 + 2 * size)
+        self.assertTrue(connection.inbuffer)
+        # Once the client reads, the rest are answered.
+        s.settimeout(5)
+        received = 0
+        while received < 50 * size:
+            chunk = s.recv(1 << 20)
+            if not chunk:
+                break
+            received += len(chunk)
+        self.assertGreater(received, 50 * size)
+
+    def test_max_connections(self):
+        """Connections over the limit get a 503, and accepting resumes once some close"""
+        port = self.serve(max_connections=2)
+        clients = []
+        for _ in range(2):
+            client = http.client.HTTPConnection("localhost", port, timeout=5)
+            client.request('GET', '/index.html')
+            response = client.getresponse()
+            response.read()
+            self.assertEqual(response.status, 200)
+            clients.append(client)
+        refused = self.read_all(self.connect(port))
+        self.assertEqual(refused, http_server.OVERLOADED)
+        self.assertTrue(self.wait_until(lambda: not self.server.accepting))
+        # Queued in the backlog until a slot frees up.
+        waiting = self.connect(port)
+        waiting.sendall(b"GET /index.html HTTP/1.1\r\nHost: x\r\nConnection: close\r\n\r\n")
+        clients.pop().close()
+        self.assertTrue(self.read_all(waiting).startswith(b"HTTP/1.1 200 "))
+        self.assertTrue(self.wait_until(lambda: self.server.accepting))
+        clients.pop().close()
+
+
+class ClosingResult(object):
+    closed = False
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+
+    def __iter__(self):
+        return iter(self.chunks)
+
+    def close(self):
+        ClosingResult.closed = True
+
+
+def wsgi_app(env, start_response):
+    path = env['PATH_INFO']
+    if path == '/stream':
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        return (b"part %d\n" % n for n in range(5))
+    if path == '/empty':
+        start_response('204 No Content', [])
+        return [b'']
+    if path == '/closing':
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        return ClosingResult([b'one', b'two'])
+    if path == '/file':
+        start_response('200 OK', [('Content-Type', 'text/html')])
+        return env['wsgi.file_wrapper'](open('dir1/page.html', 'rb'))
+    if path == '/no-start':
+        return [b'forgot start_response']
+    if path == '/not-latin-1':
+        start_response('200 OK', [('X-Name', '\u2603')])
+        return [b'snowman']
+    if path == '/wait':
+        env['test.release'].wait(5)
+    keys = ('REQUEST_METHOD', 'PATH_INFO', 'QUERY_STRING', 'CONTENT_TYPE', 'CONTENT_LENGTH',
+            'SERVER_PROTOCOL', 'HTTP_X_TEST', 'wsgi.multithread')
+    info = {key: env.get(key) for key in keys}
+    info['body'] = env['wsgi.input'].read().decode('latin-1')
+    start_response('200 OK', [('Content-Type', 'application/json')])
+    return [json.dumps(info).encode()]
+
+
+class TestWSGIServer(unittest.TestCase):
+
+    def serve(self, **options):
+        server = wsgi_server.AsyncWSGIServer(port=0, handler_class=wsgi_server.AsyncWSGIRequestHandler,
+                                             **options)
+        # Lets /wait calls finish.
+        self.release = threading.Event()
+        self.addCleanup(self.release.set)
+        server.base_environ['test.release'] = self.release
+        return start_server(self, server, wsgi_app)
+
+    def request(self, port, method, path, body=None, headers={}):
+        connection = http.client.HTTPConnection("localhost", port, timeout=5)
+        connection.request(method, path, body=body, headers=headers)
+        response = connection.getresponse()
+        data = response.read()
+        connection.close()
+        return response, data
+
+    def test_chunked_stream(self):
+        """Responses without a length are chunked"""
+        port = self.serve()
+        data = exchange(port, b"GET /stream HTTP/1.1\r\nHost: x\r\nConnection: close\r\n\r\n")
+        head, _, body = data.partition(b"\r\n\r\n")
+        self.assertIn(b"Transfer-Encoding: chunked", head)
+        self.assertNotIn(b"Content-Length", head)
+        self.assertTrue(body.startswith(b"7\r\npart 0\n\r\n"))
+        self.assertTrue(body.endswith(b"7\r\npart 4\n\r\n0\r\n\r\n"))
+
+    def test_http10_close_delimited(self):
+        """HTTP/1.0 responses without a length end with the connection"""
+        port = self.serve()
+        data = exchange(port, b"GET /stream HTTP/1.0\r\n\r\n")
+        head, _, body = data.partition(b"\r\n\r\n")
+        self.assertNotIn(b"chunked", head)
+        self.assertIn(b"Connection: close", head)
+        self.assertEqual(body, b"".join(b"part %d\n" % n for n in range(5)))
+
+    def test_bodyless_responses(self):
+        """HEAD and 204 responses carry no body"""
+        port = self.serve()
+        for request in (b"HEAD /stream HTTP/1.1\r\nHost: x\r\nConnection: close\r\n\r\n",
+                        b"GET /empty HTTP/1.1\r\nHost: x\r\nConnection: close\r\n\r\n"):
+            data = exchange(port, request)
+            self.assertTrue(data.endswith(b"\r\n\r\n"))
+            self.assertNotIn(b"chunked", data)
+
+    def test_result_closed(self):
+        """close() of the result iterable is called"""
+        port = self.serve()
+        ClosingResult.closed = False
+        response, data = self.request(port, 'GET', '/closing')
+        self.assertEqual(data, b"onetwo")
+        for _ in range(100):
+            if ClosingResult.closed:
+                break
+            time.sleep(0.01)
+        self.assertTrue(ClosingResult.closed)
+
+    def test_file_wrapper(self):
+        """wsgi.file_wrapper responses are sent whole with their length"""
+        port = self.serve()
+        response, data = self.request(port, 'GET', '/file')
+        with open('dir1/page.html', 'rb') as f:
+            expected = f.read()
+        self.assertEqual(data, expected)
+        self.assertEqual(int(response.getheader('Content-Length')), len(expected))
+
+    def test_invalid_responses(self):
+        """Responses that can't be sent get a 500, and the connection goes on"""
+        for options in ({}, {'threads': 2}):
+            port = self.serve(**options)
+            connection = http.client.HTTPConnection("localhost", port, timeout=5)
+            for path in ('/no-start', '/not-latin-1', '/stream'):
+                connection.request('GET', path)
+                response = connection.getresponse()
+                response.read()
+                self.assertEqual(response.status, 500 if path != '/stream' else 200, (options, path))
+            connection.close()
+
+    def test_environ(self):
+        """The environ carries the query, headers and a readable wsgi.input"""
+        port = self.serve()
+        response, data = self.request(port, 'POST', '/echo?a=1&b=2', body=b'hello',
+                                      headers={'Content-Type': 'text/plain', 'X-Test': 'yes'})
+        info = json.loads(data)
+        self.assertEqual(info['REQUEST_METHOD'], 'POST')
+        self.assertEqual(info['PATH_INFO'], '/echo')
+        self.assertEqual(info['QUERY_STRING'], 'a=1&b=2')
+        self.assertEqual(info['CONTENT_TYPE'], 'text/plain')
+        self.assertEqual(info['CONTENT_LENGTH'], '5')
+        self.assertEqual(info['SERVER_PROTOCOL'], 'HTTP/1.1')
+        self.assertEqual(info['HTTP_X_TEST'], 'yes')
+        self.assertEqual(info['body'], 'hello')
+        self.assertFalse(info['wsgi.multithread'])
+
+    def test_chunked_input(self):
+        """Chunked request bodies are read through wsgi.input"""
+        port = self.serve()
+        data = exchange(port, b"POST /echo HTTP/1.1\r\nHost: x\r\nConnection: close\r\n"
+                              b"Transfer-Encoding: chunked\r\n\r\n5\r\nhello\r\n6\r\n world\r\n0\r\n\r\n")
+        info = json.loads(data.partition(b"\r\n\r\n")[2])
+        self.assertEqual(info['body'], 'hello world')
+
+    def test_queue_depth(self):
+        """Calls beyond the queue depth get 503"""
+        port = self.serve(threads=1, queue_depth=1)
+        waiting = threading.Thread(target=self.request, args=(port, 'GET', '/wait'))
+        waiting.start()
+        time.sleep(0.2)
+        response, _ = self.request(port, 'GET', '/echo')
+        self.assertEqual(response.status, 503)
+        self.release.set()
+        waiting.join(5)
+        response, data = self.request(port, 'GET', '/echo')
+        self.assertEqual(response.status, 200)
+        self.assertTrue(json.loads(data)['wsgi.multithread'])
+
+
+class LifespanApp(object):
+
+    def __init__(self):
+        self.events = []
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            while True:
+                message = await receive()
+                self.events.append(message['type'])
+                if message['type'] == 'lifespan.startup':
+                    scope['state']['started'] = True
+                    await send({'type': 'lifespan.startup.complete'})
+                else:
+                    await send({'type': 'lifespan.shutdown.complete'})
+                    return
+        sizes = []
+        while True:
+            message = await receive()
+            sizes.append(len(message['body']))
+            if not message['more_body']:
+                break
+        await send({'type': 'http.response.start', 'status': 200, 'headers': [(b'content-type', b'text/plain')]})
+        for n in range(3):
+            await send({'type': 'http.response.body', 'body': b"%d " % n, 'more_body': True})
+        summary = f"{sum(sizes)} {scope['state'].get('started')}"
+        await send({'type': 'http.response.body', 'body': summary.encode()})
+
+
+class TestASGIServer(unittest.TestCase):
+
+    def serve(self, app):
+        server = asgi_server.AsyncASGIServer(port=0, handler_class=asgi_server.AsyncASGIRequestHandler)
+        return server, start_server(self, server, app)
+
+    def test_streaming(self):
+        """Request and response bodies stream through the application"""
+        _, port = self.serve(LifespanApp())
+        body = b"x" * 300000
+        data = exchange(port, b"POST / HTTP/1.1\r\nHost: x\r\nConnection: close\r\n"
+                              b"Content-Length: %d\r\n\r\n" % len(body) + body)
+        head, _, rest = data.partition(b"\r\n\r\n")
+        self.assertIn(b"Transfer-Encoding: chunked", head)
+        self.assertEqual(rest, b"2\r\n0 \r\n2\r\n1 \r\n2\r\n2 \r\nb\r\n300000 True\r\n0\r\n\r\n")
+
+    def test_lifespan(self):
+        """Lifespan startup runs before serving and shutdown after"""
+        app = LifespanApp()
+        server, port = self.serve(app)
+        self.assertEqual(app.events, ['lifespan.startup'])
+        server.loop.call_soon_threadsafe(server.loop.stop)
+        for _ in range(200):
+            if server.loop is None:
+                break
+            time.sleep(0.01)
+        self.assertEqual(app.events, ['lifespan.startup', 'lifespan.shutdown'])
+
 
 loader = unittest.TestLoader()
 suite = unittest.TestSuite()
 a = loader.loadTestsFromTestCase(TestAsyncHTTPServer)
 suite.addTest(a)
+suite.addTest(loader.loadTestsFromTestCase(TestConnectionMemory))
+suite.addTest(loader.loadTestsFromTestCase(TestParseRange))
+suite.addTest(loader.loadTestsFromTestCase(TestRouter))
+suite.addTest(loader.loadTestsFromTestCase(TestCompressedCache))
+suite.addTest(loader.loadTestsFromTestCase(TestPathResolver))
+suite.addTest(loader.loadTestsFromTestCase(TestAccessLog))
+suite.addTest(loader.loadTestsFromTestCase(TestMetrics))
+suite.addTest(loader.loadTestsFromTestCase(TestTimerWheel))
+suite.addTest(loader.loadTestsFromTestCase(TestHTTPServer))
+suite.addTest(loader.loadTestsFromTestCase(TestWSGIServer))
+suite.addTest(loader.loadTestsFromTestCase(TestASGIServer))
 
 
 class NewResult(unittest.TextTestResult):
@@ -0,0 +1,72 @@
+import logging
+import math
+
+
+class Timer(object):
+    """A callback scheduled on a ``TimerWheel``."""
+
+    __slots__ = ('tick', 'callback', 'bucket')
+
+    def __init__(self, tick, callback, bucket):
+        self.tick = tick
+        self.callback = callback
+        self.bucket = bucket
+
+    def cancel(self):
+        if self.bucket is not None:
+            self.bucket.discard(self)
+            self.bucket = None
+
+
+class TimerWheel(object):
+    """Coarse timers for connection timeouts.
+
+    Every connection re-arms a timeout on most reads, so arming and
+    cancelling have to be cheap: a timer is dropped into the slot of the
+    tick it expires on and cancelled by removing it from there, both O(1).
+    One loop callback per ``resolution`` seconds fires whatever is due in
+    the current slot.  Timers further out than a full turn of the wheel
+    share a slot with nearer ones and are skipped until their turn comes.
+    Timeouts fire up to ``resolution`` seconds late.
+    """
+
+    def __init__(self, resolution=0.5, slots=512):
+        self.resolution = resolution
+        self.slots = [set() for _ in range(slots)]
+        self.current = 0
+        self.loop = None
+        self.started = None
+        self.handle = None
+
+    def start(self, loop):
+        self.loop = loop
+        self.started = loop.time()
+        self.handle = loop.call_at(self.started + self.resolution, self.advance)
+
+    def stop(self):
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+
+    def schedule(self, delay, callback):
+        """Call ``callback`` after ``delay`` seconds, give or take a tick."""
+        # The current tick is already partly over, hence one more.
+        tick = self.current + math.ceil(delay / self.resolution) + 1
+        bucket = self.slots[tick % len(self.slots)]
+        timer = Timer(tick, callback, bucket)
+        bucket.add(timer)
+        return timer
+
+    def advance(self):
+        self.current += 1
+        bucket = self.slots[self.current % len(self.slots)]
+        due = [timer for timer in bucket if timer.tick <= self.current]
+        for timer in due:
+            timer.cancel()
+        for timer in due:
+            try:
+                timer.callback()
+            except Exception:
+                logging.exception("Error in timer callback")
+        # Scheduled from the start time so the ticks don't drift.
+        self.handle = self.loop.call_at(self.started + (self.current + 1) * self.resolution, self.advance)
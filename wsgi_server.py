@@ -1,66 +1,532 @@
+import argparse
+import asyncio
+import asgi_server
 import http_server
+import inspect
+import logging
+import os
+import re
+import router
+import stat
 import sys
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import unquote_to_bytes
 
 
-class AsyncWSGIServer(http_server.AsyncServer):
+# Latin-1 text with tabs but no other control characters.
+LATIN_1 = re.compile(r"[\t\x20-\x7e\x80-\xff]*")
 
-    def set_app(self, app):
-        self.application = app
+STATUS = re.compile(r"[0-9]{3} [\t\x20-\x7e\x80-\xff]*\Z")
 
-    def get_app(self):
-        return self.application
 
+class FileWrapper(object):
+    """``wsgi.file_wrapper``: iterates a file-like object in blocks.
 
-class AsyncWSGIRequestHandler(http_server.AsyncHTTPRequestHandler):
+    When the wrapped object is a regular file the handler bypasses the
+    iteration and sends it with ``sendfile`` instead.
+    """
 
-    def get_environ(self):
-        environ = {
+    def __init__(self, filelike, blksize=8192):
+        self.filelike = filelike
+        self.blksize = blksize
+        if hasattr(filelike, 'close'):
+            self.close = filelike.close
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        data = self.filelike.read(self.blksize)
+        if data:
+            return data
+        raise StopIteration
+
+
+class IterableProducer(object):
+    """Producer over the remainder of a WSGI response iterable.
+
+    With ``chunked`` every piece is framed as an HTTP/1.1 chunk and the
+    last-chunk marker follows the final one.  The iterable's ``close()``
+    is called once it is exhausted or the response is abandoned.
+
+    With an ``executor`` each chunk is pulled from the iterable in a pool
+    thread and ``more()`` returns a future of it.
+    """
+
+    def __init__(self, result, iterator, chunked=False, executor=None):
+        self.result = result
+        self.iterator = iterator
+        self.chunked = chunked
+        self.executor = executor
+        self.running = False
+        self.abandoned = False
+
+    def more(self):
+        if self.executor is not None and self.iterator is not None:
+            return asyncio.get_running_loop().run_in_executor(self.executor, self.next_chunk)
+        return self.next_chunk()
+
+    def next_chunk(self):
+        if self.iterator is None:
+            return b""
+        self.running = True
+        try:
+            for data in self.iterator:
+                if data:
+                    return http_server.frame(data, self.chunked)
+            self.iterator = None
+        finally:
+            self.running = False
+            if self.abandoned:
+                self.close()
+        self.close_result()
+        return b"0\r\n\r\n" if self.chunked else b""
+
+    def close(self):
+        if self.running:
+            # A pool thread is inside the iterable; it closes it when done.
+            self.abandoned = True
+            return
+        if self.iterator is not None:
+            self.iterator = None
+            self.close_result()
+
+    def close_result(self):
+        if hasattr(self.result, 'close'):
+            self.result.close()
+
+
+class AsyncWSGIServer(http_server.AsyncServer):
+    """Server for a WSGI application.
+
+    With ``threads`` the application runs in a pool of that many threads
+    instead of on the event loop, so a slow call only holds up its own
+    connection.  At most ``queue_depth`` calls may be running or waiting
+    for a thread; requests beyond that get 503 straight away.
+
+    With a ``router`` requests are dispatched by path prefix to the
+    applications and static directories mounted there instead of going
+    to the one application.
+    """
+
+    def __init__(self, *args, threads=0, queue_depth=64, router=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.router = router
+        self.executor = None
+        if threads:
+            self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='wsgi')
+        self.queue_depth = queue_depth
+        self.pending = 0
+        self.base_environ = {
             'wsgi.version': (1, 0),
             'wsgi.url_scheme': 'http',
-            'wsgi.input': sys.stdin,
             'wsgi.errors': sys.stderr,
-            'wsgi.multithread': False,
+            'wsgi.multithread': self.executor is not None,
             'wsgi.multiprocess': False,
             'wsgi.run_once': False,
-            'REQUEST_METHOD': self.method,
-            'PATH_INFO': self.path,
-            'SERVER_NAME': self.server_name,
-            'SERVER_PORT': str(self.server_port)
+            'wsgi.input_terminated': True,
+            'wsgi.file_wrapper': FileWrapper,
+            'SCRIPT_NAME': '',
+            'SERVER_NAME': self.host,
+            'SERVER_PORT': str(self.port),
+            'SERVER_SOFTWARE': '127.0.0.1',
         }
 
+    def cache_stats(self):
+        caches = super().cache_stats()
+        if self.router is not None:
+            # The mounts' resolvers stand in for the unused default one.
+            path = dict.fromkeys(caches['path'], 0)
+            for resolver in self.router.resolvers():
+                for name, value in resolver.stats().items():
+                    path[name] += value
+            caches['path'] = path
+        return caches
+
+    async def startup(self):
+        if self.router is not None:
+            for resolver in self.router.resolvers():
+                resolver.start(self.loop)
+
+    def close(self):
+        if self.router is not None:
+            for resolver in self.router.resolvers():
+                resolver.stop()
+        super().close()
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+
+    def set_app(self, app):
+        self.application = app
+
+    def get_app(self):
+        return self.application
+
+
+class AsyncWSGIRequestHandler(http_server.AsyncHTTPRequestHandler):
+    """Runs the WSGI application and streams its response.
+
+    Headers are held back until the application yields its first non-empty
+    chunk.  The body is then written as it is produced, waiting for the
+    client whenever the transport buffer is full.  Without a
+    Content-Length from the application an HTTP/1.1 response is chunked and
+    an HTTP/1.0 one is delimited by closing the connection.
+
+    The request body is spooled as it arrives and ``wsgi.input`` reads
+    straight from the spool, so it is never copied into one string.
+    """
+
+    __slots__ = ('status', 'response_headers', 'headers_sent', 'response_chunked', 'bodyless')
+
+    split_multipart = False
+
+    def reset(self):
+        super().reset()
+        self.status = None
+        self.response_headers = []
+        self.headers_sent = False
+        self.response_chunked = False
+        self.bodyless = False
+
+    def get_environ(self):
+        environ = self.server.base_environ.copy()
+        path, _, query = self.path.partition('?')
+        environ['REQUEST_METHOD'] = self.method
+        environ['PATH_INFO'] = unquote_to_bytes(path).decode('latin-1')
+        environ['QUERY_STRING'] = query
+        environ['SERVER_PROTOCOL'] = self.request_version
+        environ['CONTENT_LENGTH'] = str(self.request_body.size) if self.request_body.size else ''
+        environ['wsgi.input'] = self.request_body.file
+        peer = self.transport.get_extra_info('peername')
+        if peer:
+            environ['REMOTE_ADDR'] = peer[0]
+            environ['REMOTE_PORT'] = str(peer[1])
+        for name, value in self.headers.items():
+            if name == 'content-type':
+                environ['CONTENT_TYPE'] = value
+            elif name == 'content-length' or '_' in name:
+                # Underscored names would be indistinguishable from dashed ones.
+                continue
+            else:
+                environ['HTTP_' + name.upper().replace('-', '_')] = value
         return environ
 
-    def start_response(self, status, response_headers):
-        code, message = status.split(" ")
-        self.init_response(code, message)
-        for key, value in response_headers:
-            self.headers[key] = value
+    def start_response(self, status, response_headers, exc_info=None):
+        if exc_info:
+            try:
+                if self.headers_sent:
+                    raise exc_info[1].with_traceback(exc_info[2])
+            finally:
+                exc_info = None
+        elif self.status is not None:
+            raise AssertionError("start_response called twice without exc_info")
+        check_response(status, response_headers)
+        self.status = status
+        self.response_headers = response_headers
+        return self.write
+
+    def write(self, data):
+        """The legacy ``write`` callable returned by ``start_response``."""
+        if self.server.executor is not None:
+            # Called from a pool thread; output is only touched on the loop.
+            self.server.loop.call_soon_threadsafe(self.write_output, data)
+        else:
+            self.write_output(data)
+
+    def write_output(self, data):
+        if self.transport is None:
+            return
+        if not self.headers_sent:
+            self.send_response_headers()
+        if data and not self.bodyless:
+            self.push(http_server.frame(data, self.response_chunked))
+        self.initiate_send()
 
     def handle_request(self):
+        router = self.server.router
+        if router is None:
+            app = self.server.get_app()
+        else:
+            path = unquote_to_bytes(self.path.partition('?')[0]).decode('latin-1')
+            mount, path_info = router.match(path)
+            if mount is None:
+                self.send_error(404)
+                return
+            if mount.app is None:
+                if self.method not in ('GET', 'HEAD'):
+                    self.send_error(405)
+                    return
+                super().handle_request()
+                return
+            app = mount.app
+        self.route = 'wsgi'
         env = self.get_environ()
-        app = server.get_app()
+        if router is not None:
+            env['SCRIPT_NAME'] = mount.prefix
+            env['PATH_INFO'] = path_info
+        if self.server.executor is None:
+            try:
+                response = self.run_application(app, env)
+            except Exception:
+                logging.exception("Error in WSGI application")
+                self.application_failed()
+                return
+            self.send_application_response(response)
+            return
+        if self.server.pending >= self.server.queue_depth:
+            self.send_error(503)
+            return
+        self.server.pending += 1
+        # Hold back pipelined requests until this one is answered.
+        self.busy = True
+        future = self.server.loop.run_in_executor(self.server.executor, self.run_application, app, env)
+        future.add_done_callback(self.application_done)
+
+    def static_resolver(self, key):
+        if self.server.router is None:
+            return super().static_resolver(key)
+        # Matched again after normalizing, which may have left the mount.
+        mount, path = self.server.router.match(key)
+        if mount is None or mount.resolver is None:
+            return None
+        return mount.resolver, path or '/'
+
+    def run_application(self, app, env):
+        """Call the application and iterate it up to the first non-empty chunk.
+
+        Returns ``(result, iterator, first)``; start_response has normally
+        been called by then, so the headers can go out with that chunk.
+        """
         result = app(env, self.start_response)
-        self.finish_response(result)
-
-    def finish_response(self, result):
-        self.add_header("Content-Type", 'text/html')
-        self.add_header("Date", self.date_time_string())
-        self.add_header("Server", '127.0.0.1')
-        self.add_header("Content-Length", len(result[0]))
-        self.add_header("Connection", "close")
+        if isinstance(result, FileWrapper):
+            return result, None, b""
+        iterator = iter(result)
+        first = b""
+        try:
+            for first in iterator:
+                if first:
+                    break
+        except Exception:
+            if hasattr(result, 'close'):
+                result.close()
+            raise
+        if self.status is None:
+            if hasattr(result, 'close'):
+                result.close()
+            raise AssertionError("The application returned without calling start_response")
+        return result, iterator, first
+
+    def application_done(self, future):
+        self.server.pending -= 1
+        try:
+            response = future.result()
+        except Exception as e:
+            logging.error("Error in WSGI application", exc_info=e)
+            if self.transport is not None:
+                self.application_failed()
+            return
+        if self.transport is None:
+            result = response[0]
+            if hasattr(result, 'close'):
+                result.close()
+            return
+        self.send_application_response(response)
+
+    def send_application_response(self, response):
+        """``finish_response``, answering 500 if the response can't be sent."""
+        try:
+            self.finish_response(*response)
+        except Exception:
+            logging.exception("Error in WSGI response")
+            result = response[0]
+            if hasattr(result, 'close'):
+                result.close()
+            self.application_failed()
+
+    def application_failed(self):
+        if self.headers_sent:
+            self.close()
+        else:
+            self.send_error(500)
+
+    def send_response_headers(self, length=None):
+        """Queue the status line and headers given to ``start_response``.
+
+        ``length`` is the body size when it is known without iterating.
+        """
+        code, _, message = self.status.partition(" ")
+        self.init_response(code, message)
+        names = set()
+        for name, value in self.response_headers:
+            key = name.lower()
+            if key in ('connection', 'keep-alive', 'transfer-encoding'):
+                # Hop-by-hop headers are the server's business.
+                continue
+            names.add(key)
+            self.add_header(name, value)
+        if 'date' not in names:
+            self.add_raw_header(self.server.clock.header)
+        if 'server' not in names:
+            self.add_raw_header(http_server.SERVER_HEADER)
+        self.bodyless = self.method == 'HEAD' or code in ('204', '304') or code.startswith('1')
+        if 'content-length' not in names and not self.bodyless:
+            if length is not None:
+                self.add_header("Content-Length", length)
+            elif self.request_version == 'HTTP/1.1':
+                self.add_header("Transfer-Encoding", "chunked")
+                self.response_chunked = True
+            else:
+                self.close_connection = True
+        self.add_connection_header()
         self.end_headers()
-        self.response += result[0].decode('utf-8')
-        self.send(self.response.encode('utf-8'))
-        self.close()
+        self.push(self.response_head())
+        self.headers_sent = True
 
+    def finish_response(self, result, iterator, first):
+        if iterator is None:
+            if self.send_file_wrapper(result):
+                return
+            iterator = iter(result)
+        length = sum(map(len, result)) if isinstance(result, (list, tuple)) else None
+        if not self.headers_sent:
+            self.send_response_headers(length)
+        producer = IterableProducer(result, iterator, self.response_chunked, self.server.executor)
+        if self.bodyless:
+            producer.close()
+        else:
+            if first:
+                self.push(http_server.frame(first, self.response_chunked))
+            self.push_with_producer(producer)
+        self.initiate_send()
+        self.end_request()
 
-if __name__ == '__main__':
-    if len(sys.argv) < 2:
-        sys.exit('Provide a WSGI application object as module:callable')
-    app_path = sys.argv[1]
-    module, application = app_path.split(':')
+    def send_file_wrapper(self, wrapper):
+        """Send a wrapped regular file with sendfile; False if it isn't one."""
+        if self.headers_sent:
+            return False
+        try:
+            fd = wrapper.filelike.fileno()
+            offset = wrapper.filelike.tell()
+            fstat = os.fstat(fd)
+        except (AttributeError, OSError, ValueError):
+            return False
+        if not stat.S_ISREG(fstat.st_mode):
+            return False
+        count = max(fstat.st_size - offset, 0)
+        for name, value in self.response_headers:
+            if name.lower() == 'content-length':
+                count = min(count, int(value))
+        self.send_response_headers(count)
+        if self.bodyless or not count:
+            wrapper.close()
+            self.initiate_send()
+        else:
+            self.send_file(wrapper.filelike, offset, count)
+        self.end_request()
+        return True
+
+
+def check_response(status, response_headers):
+    """Reject a status or headers that PEP 3333 doesn't allow.
+
+    They have to be native strings that encode as latin-1, without
+    control characters, so that they can't break up the response head.
+    """
+    if type(status) is not str or not STATUS.match(status):
+        raise AssertionError(f"Invalid status {status!r}")
+    for name, value in response_headers:
+        if type(name) is not str or type(value) is not str:
+            raise AssertionError(f"Header {name!r}: {value!r} isn't a pair of strings")
+        if not LATIN_1.fullmatch(name) or not LATIN_1.fullmatch(value):
+            raise AssertionError(f"Header {name!r}: {value!r} isn't latin-1 text")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser("Asynchronous WSGI/ASGI server")
+    parser.add_argument("app", nargs='?', default=None,
+                        help="WSGI or ASGI application object as module:callable")
+    parser.add_argument("--mount", dest="mounts", action="append", default=[], metavar="PREFIX=TARGET",
+                        help="serve a WSGI application (module:callable) or a static directory under "
+                             "PREFIX; may be repeated, the app argument is mounted at /")
+    parser.add_argument("--interface", dest="interface", choices=("auto", "wsgi", "asgi"), default="auto",
+                        help="auto picks ASGI for coroutine callables")
+    parser.add_argument("--host", dest="host", default="127.0.0.1")
+    parser.add_argument("--port", dest="port", type=int, default=9000)
+    parser.add_argument("--log", dest="loglevel", default="info")
+    parser.add_argument("--access-log", dest="access_log", default=None,
+                        help="file to log requests to, - for stdout")
+    parser.add_argument("--access-log-format", dest="access_log_format", choices=("text", "json"), default="text")
+    parser.add_argument("--loop", dest="loop", choices=http_server.LOOPS, default="auto")
+    parser.add_argument("--threads", dest="threads", type=int, default=0,
+                        help="run a WSGI application in a pool of this many threads, 0 runs it on the event loop")
+    parser.add_argument("--queue-depth", dest="queue_depth", type=int, default=64,
+                        help="calls running or waiting for a thread before answering 503")
+    parser.add_argument("--backlog", dest="backlog", type=int, default=1024)
+    parser.add_argument("--max-connections", dest="max_connections", type=int, default=10000,
+                        help="open connections before answering 503 and pausing accept")
+    parser.add_argument("--metrics-path", dest="metrics_path", default=None,
+                        help="serve Prometheus metrics at this path, e.g. /metrics")
+    parser.add_argument("--metrics-port", dest="metrics_port", type=int, default=None,
+                        help="serve Prometheus metrics on this port instead of the public one")
+    args = parser.parse_args()
+    problem = http_server.loop_unavailable(args.loop)
+    if problem is not None:
+        parser.error(problem)
+    return args
+
+
+def load_app(name):
+    module, application = name.split(':')
     module = __import__(module)
-    application = getattr(module, application)
-    server = AsyncWSGIServer(handler_class=AsyncWSGIRequestHandler)
+    return getattr(module, application)
+
+
+def is_asgi(application):
+    return (inspect.iscoroutinefunction(application)
+            or inspect.iscoroutinefunction(getattr(application, '__call__', None)))
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    logging.basicConfig(level=getattr(logging, args.loglevel.upper()),
+                        format="%(name)s: %(process)d %(message)s")
+    http_server.raise_fd_limit()
+    application = mounts = None
+    if args.app is not None:
+        application = load_app(args.app)
+    if args.mounts:
+        mounts = router.Router()
+        if application is not None:
+            mounts.mount('/', app=application)
+        for option in args.mounts:
+            prefix, _, target = option.partition('=')
+            if not prefix.startswith('/') or not target:
+                sys.exit(f"--mount takes PREFIX=TARGET, got {option}")
+            if os.path.isdir(target):
+                mounts.mount(prefix, directory=target)
+            else:
+                mounts.mount(prefix, app=load_app(target))
+        if args.interface == 'asgi' or any(mount.app is not None and is_asgi(mount.app) for mount in mounts.mounts):
+            sys.exit("Only WSGI applications can be mounted")
+    elif application is None:
+        sys.exit("Give an application or at least one --mount")
+    metrics = metrics_sock = None
+    if args.metrics_port is not None:
+        metrics_sock = http_server.bind_socket(args.host, args.metrics_port)
+    if args.metrics_path is not None or metrics_sock is not None:
+        metrics = http_server.Metrics()
+    access_log = None
+    if args.access_log is not None:
+        access_log = http_server.AccessLog(args.access_log, args.access_log_format)
+    options = dict(loop=args.loop, access_log=access_log, backlog=args.backlog, max_connections=args.max_connections,
+                   metrics=metrics, metrics_path=args.metrics_path, metrics_sock=metrics_sock)
+    if mounts is not None and mounts.resolvers():
+        options.update(file_cache=http_server.FileCache(), compressed_cache=http_server.CompressedCache())
+    if mounts is None and (args.interface == 'asgi' or (args.interface == 'auto' and is_asgi(application))):
+        server = asgi_server.AsyncASGIServer(host=args.host, port=args.port,
+                                             handler_class=asgi_server.AsyncASGIRequestHandler, **options)
+    else:
+        server = AsyncWSGIServer(host=args.host, port=args.port, handler_class=AsyncWSGIRequestHandler,
+                                 threads=args.threads, queue_depth=args.queue_depth, router=mounts, **options)
     server.set_app(application)
     server.serve_forever()